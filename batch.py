@@ -0,0 +1,68 @@
+"""
+Calculate the dashboard metrics for a whole portfolio of restaurants, outside of the
+Streamlit app.
+
+Restaurants are read from a CSV or Parquet file with `lat`, `lon`, `tz` and (optionally)
+`units` columns, and the results are written as a single Parquet (or CSV) file:
+
+    python batch.py restaurants.csv metrics.parquet --date-range next_30_days
+
+Add `--events events.parquet` to also export the events within each restaurant's radius.
+"""
+import argparse
+import logging
+import sys
+import time
+from utils.batch import read_locations, run_batch, fetch_batch_events, write_results
+from utils.predicthq import get_api_key
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("input", help="CSV or Parquet file of restaurants.")
+    parser.add_argument("output", help="Parquet (or .csv) file to write.")
+    parser.add_argument(
+        "--date-range",
+        choices=["next_7_days", "next_30_days", "next_90_days"],
+        default="next_90_days",
+        help="Date range of the metrics (default next_90_days).",
+    )
+    parser.add_argument(
+        "--events",
+        default=None,
+        help="Also write the events within each restaurant's radius to this Parquet (or .csv) file.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Restaurants processed at a time.",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    if get_api_key() is None:
+        sys.exit("Please set a PredictHQ API Token.")
+
+    started = time.time()
+    locations = read_locations(args.input)
+    results = run_batch(locations, args.date_range, args.workers)
+    write_results(results, args.output)
+
+    if args.events:
+        write_results(fetch_batch_events(results), args.events)
+
+    failed = results["error"].notna().sum()
+    logging.info(
+        "Calculated metrics for %d restaurants in %.1fs (%d failed)",
+        len(results),
+        time.time() - started,
+        failed,
+    )
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
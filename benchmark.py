@@ -0,0 +1,94 @@
+"""
+Benchmark the app's data and rendering paths offline, against a fake PredictHQ API.
+
+Requests go through the SDK and the cache as usual but are answered with synthetic
+responses (or recorded ones, see --fixtures), at 10, 1k and 100k events and 7 to 365
+days. Results are written as JSON, so runs can be compared before deploying:
+
+    python benchmark.py baseline.json
+    python benchmark.py results.json --compare baseline.json
+"""
+import argparse
+import json
+import logging
+import sys
+from utils.benchmark import (
+    read_fixtures,
+    run_benchmarks,
+    compare_results,
+    EVENT_SIZES,
+    DAY_COUNTS,
+    REPEAT,
+    REGRESSION_THRESHOLD,
+)
+
+
+def parse_sizes(value):
+    return [int(size) for size in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("output", help="JSON file to write the results to.")
+    parser.add_argument(
+        "--events",
+        type=parse_sizes,
+        default=EVENT_SIZES,
+        help="Comma separated numbers of events (default 10,1000,100000).",
+    )
+    parser.add_argument(
+        "--days",
+        type=parse_sizes,
+        default=DAY_COUNTS,
+        help="Comma separated numbers of days (default 7,30,90,365).",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=REPEAT,
+        help=f"Runs of each benchmark (default {REPEAT}).",
+    )
+    parser.add_argument(
+        "--fixtures",
+        default=None,
+        help="Folder of recorded responses, one <endpoint>.json file per endpoint.",
+    )
+    parser.add_argument(
+        "--compare",
+        default=None,
+        help="Results of a previous run to compare with, exits with 1 on regressions.",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=REGRESSION_THRESHOLD,
+        help=f"Slowdown counted as a regression (default {REGRESSION_THRESHOLD}).",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    results = run_benchmarks(
+        args.events,
+        args.days,
+        args.repeat,
+        read_fixtures(args.fixtures) if args.fixtures else None,
+    )
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    logging.info("Wrote %d results to %s", len(results["results"]), args.output)
+
+    if not args.compare:
+        return
+
+    with open(args.compare) as f:
+        comparison = compare_results(json.load(f), results, args.threshold)
+
+    print(comparison.to_string(index=False))
+    sys.exit(1 if comparison["regression"].any() else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,40 @@
 import streamlit as st
-import pytz
+import numpy as np
 import pandas as pd
 from utils.pages import set_page_config
-from utils.sidebar import show_sidebar_options, show_map_sidebar_code_examples
+from utils.sidebar import (
+    show_sidebar_options,
+    show_map_sidebar_code_examples,
+    show_cache_stats,
+    show_timings,
+)
+from utils.prewarm import start_background_prewarm
 from utils.metrics import show_metrics
 from utils.predicthq import (
     get_api_key,
-    fetch_events,
+    stream_events,
+    ALL_CATEGORIES,
     ATTENDED_CATEGORIES,
-    NON_ATTENDED_CATEGORIES,
-    UNSCHEDULED_CATEGORIES,
 )
 from utils.map import show_map
+from utils.geo import calc_meters
+from utils.timings import track_timings, timed
 
 
 def main():
     set_page_config("Map")
-    show_sidebar_options()
 
-    if get_api_key() is not None:
-        map()
-    else:
-        st.warning("Please set a PredictHQ API Token.", icon="⚠️")
+    with track_timings("map") as timings:
+        show_sidebar_options()
+        start_background_prewarm()
+
+        if get_api_key() is not None:
+            map()
+        else:
+            st.warning("Please set a PredictHQ API Token.", icon="⚠️")
+
+    show_cache_stats()
+    show_timings(timings)
 
 
 def map():
@@ -52,11 +65,10 @@ def map():
     date_to = daterange["date_to"]
 
     # Allow selecting categories
-    categories = ATTENDED_CATEGORIES + NON_ATTENDED_CATEGORIES + UNSCHEDULED_CATEGORIES
     default_categories = ATTENDED_CATEGORIES
     selected_categories = st.sidebar.multiselect(
         "Event categories",
-        options=categories,
+        options=ALL_CATEGORIES,
         default=default_categories,
         help="[Event Categories Docs](https://docs.predicthq.com/resources/events)",
     )
@@ -64,18 +76,49 @@ def map():
     # We have a bunch of code examples in the docs/code_examples folder
     show_map_sidebar_code_examples()
 
-    # Fetch events
-    events = fetch_events(
-        location["lat"],
-        location["lon"],
-        radius=radius,
-        date_from=date_from,
-        date_to=date_to,
-        tz=location["tz"],
-        categories=selected_categories,
-        radius_unit=suggested_radius["radius_unit"],
-    )
+    # Events are loaded page by page, so show the first page while the rest are loading
+    progress = st.progress(0.0, text="Loading events...")
+    events_placeholder = st.empty()
+    pages = []
+
+    for page_number, (page_events, loaded, total) in enumerate(
+        stream_events(
+            location["lat"],
+            location["lon"],
+            radius=radius,
+            date_from=date_from,
+            date_to=date_to,
+            tz=location["tz"],
+            categories=selected_categories,
+            radius_unit=suggested_radius["radius_unit"],
+        )
+    ):
+        pages.append(page_events)
+        progress.progress(
+            loaded / total if total > 0 else 1.0,
+            text=f"Loaded {loaded:,} of {total:,} events",
+        )
+
+        if page_number == 0 and loaded < total:
+            with events_placeholder.container():
+                show_events(location, radius, suggested_radius, page_events)
+
+    progress.empty()
 
+    # The pages are only put together once they're all loaded
+    events = pd.concat(pages, ignore_index=True)
+
+    with events_placeholder.container():
+        show_events(
+            location,
+            radius,
+            suggested_radius,
+            events,
+            filename=f'events-{location["id"]}-{date_from}-to-{date_to}',
+        )
+
+
+def show_events(location, radius, suggested_radius, events, filename=None):
     # Show map and convert radius miles to meters (the map only supports meters)
     show_map(
         lat=location["lat"],
@@ -84,65 +127,38 @@ def map():
         events=events,
     )
 
-    show_events_list(events, f'events-{location["id"]}-{date_from}-to-{date_to}')
-
+    # The download is only offered once all the events are loaded
+    show_events_list(events, filename, show_download=filename is not None)
 
-def calc_meters(value, unit):
-    if unit == "mi":
-        return value * 1609
-    if unit == "ft":
-        return value * 0.3048
-    elif unit == "km":
-        return value * 1000
-    else:
-        return value
 
-
-def show_events_list(events, filename="events"):
+@timed("show_events_list")
+def show_events_list(events, filename="events", show_download=True):
     """
-    We're also converting start/end times to local timezone here from UTC.
+    We're also converting start/end times to local timezone here from UTC. The rows are
+    built a column at a time, so this stays fast for tens of thousands of events.
     """
-    results = []
-
-    for event in events["results"]:
-        venue = next(
-            filter(lambda entity: entity["type"] == "venue", event["entities"]), None
-        )
-
-        row = {
-            "id": event["id"],
-            "title": event["title"],
-            "phq_attendance": event["phq_attendance"] if event["phq_attendance"] else 0,
-            "category": event["category"],
-            "start_date_local": event["start"]
-            .astimezone(pytz.timezone(event["timezone"]))
-            .isoformat()
-            if event["timezone"] is not None
-            else event["start"].isoformat(),
-            "end_date_local": event["end"]
-            .astimezone(pytz.timezone(event["timezone"]))
-            .isoformat()
-            if event["timezone"] is not None
-            else event["end"].isoformat(),
-            "predicted_end_date_local": event["predicted_end"]
-            .astimezone(pytz.timezone(event["timezone"]))
-            .isoformat()
-            if "predicted_end" in event
-            and event["predicted_end"] is not None
-            and event["timezone"] is not None
-            else "",
-            "venue_name": venue["name"] if venue else "",
-            "venue_address": venue["formatted_address"] if venue else "",
-            "placekey": event["geo"]["placekey"]
-            if "geo" in event and "placekey" in event["geo"]
-            else "",
+    events_df = pd.DataFrame(
+        {
+            "id": events["id"],
+            "title": events["title"],
+            "phq_attendance": events["phq_attendance"],
+            "category": events["category"],
+            "start_date_local": format_local_times(events["start"], events["timezone"]),
+            "end_date_local": format_local_times(events["end"], events["timezone"]),
+            # Only shown for events with a timezone
+            "predicted_end_date_local": format_local_times(
+                events["predicted_end"], events["timezone"]
+            ).where(events["timezone"].notna(), ""),
+            "venue_name": events["venue_name"],
+            "venue_address": events["venue_address"],
+            "placekey": events["placekey"],
         }
-
-        results.append(row)
-
-    events_df = pd.DataFrame(results)
+    )
     st.dataframe(events_df)
 
+    if not show_download:
+        return
+
     @st.cache_data
     def convert_df(df):
         return df.to_csv().encode("utf-8")
@@ -157,5 +173,37 @@ def show_events_list(events, filename="events"):
     )
 
 
+def format_local_times(times, timezones):
+    """
+    Convert UTC times to each event's timezone (UTC for events without one) and format
+    them like datetime.isoformat(). Events are grouped by timezone so each group is
+    converted in one go. Missing times are formatted as an empty string.
+    """
+    timezones = timezones.fillna("UTC")
+    utc_times = times.dt.tz_localize(None)
+    local_times = utc_times.copy()
+
+    for tz, index in timezones.groupby(timezones).groups.items():
+        local_times.loc[index] = times.loc[index].dt.tz_convert(tz).dt.tz_localize(None)
+
+    # There are only a handful of distinct UTC offsets, so format each of them once
+    offsets = (local_times - utc_times).dt.total_seconds() // 60
+    offset_strings = offsets.map(
+        {offset: format_utc_offset(offset) for offset in offsets.dropna().unique()}
+    )
+
+    formatted = pd.Series(
+        np.datetime_as_string(local_times.to_numpy(), unit="s"), index=times.index
+    )
+
+    return (formatted + offset_strings).where(times.notna(), "")
+
+
+def format_utc_offset(minutes):
+    sign = "-" if minutes < 0 else "+"
+    hours, minutes = divmod(abs(int(minutes)), 60)
+    return f"{sign}{hours:02d}:{minutes:02d}"
+
+
 if __name__ == "__main__":
     main()
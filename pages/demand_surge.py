@@ -1,28 +1,40 @@
 import streamlit as st
 import plotly.express as px
-import pandas as pd
 from utils.pages import set_page_config
-from utils.sidebar import show_sidebar_options
-from utils.metrics import show_metrics
+from utils.sidebar import show_sidebar_options, show_cache_stats, show_timings
+from utils.prewarm import start_background_prewarm
+from utils.metrics import show_metrics, calc_previous_date_range
+from utils.features import (
+    fetch_features_matrix,
+    filter_dates,
+    calc_daily_sums,
+    calc_daily_sums_by_feature,
+)
 from utils.predicthq import (
     get_api_key,
-    fetch_features,
     fetch_demand_surges,
     PHQ_ATTENDANCE_FEATURES,
 )
+from utils.timings import track_timings, timed
 
 
 def main():
     set_page_config("Demand Surge")
-    show_sidebar_options()
-
-    if get_api_key() is not None:
-        demand_surge()
-    else:
-        st.warning(
-            "Please set a [PredictHQ API Token](https://docs.predicthq.com/oauth2/introduction).",
-            icon="⚠️",
-        )
+
+    with track_timings("demand_surge") as timings:
+        show_sidebar_options()
+        start_background_prewarm()
+
+        if get_api_key() is not None:
+            demand_surge()
+        else:
+            st.warning(
+                "Please set a [PredictHQ API Token](https://docs.predicthq.com/oauth2/introduction).",
+                icon="⚠️",
+            )
+
+    show_cache_stats()
+    show_timings(timings)
 
 
 def demand_surge():
@@ -52,18 +64,23 @@ def demand_surge():
     date_from = daterange["date_from"]
     date_to = daterange["date_to"]
 
-    # Fetch sum of Predicted Attendance
-    phq_attendance_features = fetch_features(
-        location["lat"],
-        location["lon"],
-        radius,
-        date_from=date_from,
-        date_to=date_to,
-        features=PHQ_ATTENDANCE_FEATURES,
-    )
-
-    phq_attendance_daily_sum = calc_daily_sum_of_features(
-        phq_attendance_features, PHQ_ATTENDANCE_FEATURES
+    # Fetch sum of Predicted Attendance. We request the same window (previous + current
+    # period) as show_metrics so this is served from the cache, then only use the
+    # current period.
+    previous_date_from, _ = calc_previous_date_range(date_from, date_to)
+
+    # The parsed matrix is cached too, so the metrics and both charts share it
+    phq_attendance_matrix = filter_dates(
+        fetch_features_matrix(
+            location["lat"],
+            location["lon"],
+            radius,
+            date_from=previous_date_from,
+            date_to=date_to,
+            features=PHQ_ATTENDANCE_FEATURES,
+        ),
+        date_from,
+        date_to,
     )
 
     # Fetch Demand Surges
@@ -75,93 +92,58 @@ def demand_surge():
     tab1, tab2 = st.tabs(["Total Daily Attendance", "Daily Attendance by Feature"])
 
     with tab1:
-        phq_attendance_daily_sum_df = pd.DataFrame(phq_attendance_daily_sum)
-
-        fig = px.area(
-            phq_attendance_daily_sum_df,
-            x="date",
-            y="phq_attendance_sum",
-        )
-
-        for demand_surge in demand_surges:
-            fig.add_vline(
-                x=demand_surge["date"],
-                line_width=5,
-                line_color="green",
-                opacity=0.5,
-                layer="below",
-            )
-
+        fig = make_daily_attendance_chart(phq_attendance_matrix, demand_surges)
         st.plotly_chart(fig, use_container_width=True, theme="streamlit")
     with tab2:
-        features_daily_sum = get_daily_sums_of_features(
-            phq_attendance_features, PHQ_ATTENDANCE_FEATURES
-        )
-        features_daily_sum_df = pd.DataFrame(features_daily_sum)
-
-        fig = px.bar(
-            features_daily_sum_df,
-            x="date",
-            y="phq_attendance_sum",
-            color="feature",
-        )
-
-        # Add demand surges to the chart
-        for demand_surge in demand_surges:
-            fig.add_vline(
-                x=demand_surge["date"],
-                line_width=5,
-                line_color="green",
-                opacity=0.5,
-                layer="below",
-            )
-
-        # fig.update_layout(
-        #     legend=dict(orientation="h", yanchor="top", y=-0.3, xanchor="right", x=1)
-        # )
-        fig.update_layout(legend=dict(yanchor="top", y=0.99, xanchor="left", x=0.01))
-        fig.update_layout(legend_title_text="")
-
+        fig = make_attendance_by_feature_chart(phq_attendance_matrix, demand_surges)
         st.plotly_chart(fig, use_container_width=True, theme="streamlit")
 
 
-def calc_daily_sum_of_features(features_result, features):
-    # sum up the attendance features per date
-    results = []
-
-    for item in features_result["results"]:
-        phq_attendance_sum = 0
-
-        for k, v in item.items():
-            phq_attendance_sum += v["stats"]["sum"] if k in features else 0
-
-        results.append(
-            {
-                "date": item["date"],
-                "phq_attendance_sum": phq_attendance_sum,
-            }
-        )
-
-    return results
+@timed("make_daily_attendance_chart")
+def make_daily_attendance_chart(phq_attendance_matrix, demand_surges):
+    phq_attendance_daily_sum_df = calc_daily_sums(phq_attendance_matrix)
 
+    fig = px.area(
+        phq_attendance_daily_sum_df,
+        x="date",
+        y="phq_attendance_sum",
+    )
+    add_demand_surges(fig, demand_surges)
 
-def get_daily_sums_of_features(features_result, features):
-    # Pull out just the sum of each feature per date
-    results = []
+    return fig
 
-    for item in features_result["results"]:
 
-        for k, v in item.items():
-            if k in features:
-                results.append(
-                    {
-                        "date": item["date"],
-                        "feature": k,
-                        "phq_attendance_sum": v["stats"]["sum"],
-                    }
-                )
+@timed("make_attendance_by_feature_chart")
+def make_attendance_by_feature_chart(phq_attendance_matrix, demand_surges):
+    features_daily_sum_df = calc_daily_sums_by_feature(phq_attendance_matrix)
 
-    return results
+    fig = px.bar(
+        features_daily_sum_df,
+        x="date",
+        y="phq_attendance_sum",
+        color="feature",
+    )
+    add_demand_surges(fig, demand_surges)
+
+    # fig.update_layout(
+    #     legend=dict(orientation="h", yanchor="top", y=-0.3, xanchor="right", x=1)
+    # )
+    fig.update_layout(legend=dict(yanchor="top", y=0.99, xanchor="left", x=0.01))
+    fig.update_layout(legend_title_text="")
+
+    return fig
+
+
+def add_demand_surges(fig, demand_surges):
+    # Add demand surges to the chart
+    for demand_surge in demand_surges:
+        fig.add_vline(
+            x=demand_surge["date"],
+            line_width=5,
+            line_color="green",
+            opacity=0.5,
+            layer="below",
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,57 @@
+"""
+Pre-warm the cache for every restaurant and date range, outside of the Streamlit app.
+
+The app and this script only share data through the persistent cache, so set
+`cache_path` in .streamlit/secrets.toml first. Run once (e.g. from cron):
+
+    python prewarm.py --once
+
+or keep running, refreshing everything every hour:
+
+    python prewarm.py --interval 3600
+"""
+import argparse
+import logging
+import sys
+from utils.disk_cache import get_disk_cache_path
+from utils.predicthq import get_api_key
+from utils.prewarm import prewarm_all, run_prewarm_loop
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--once", action="store_true", help="Pre-warm the cache once and exit."
+    )
+    parser.add_argument(
+        "--interval",
+        type=int,
+        default=60 * 60,
+        help="Seconds between runs (default 3600).",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Location/date range combinations pre-fetched at a time.",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    if get_api_key() is None:
+        sys.exit("Please set a PredictHQ API Token.")
+
+    if get_disk_cache_path() is None:
+        logging.warning(
+            "`cache_path` isn't set, the app won't see the pre-warmed cache"
+        )
+
+    if args.once:
+        sys.exit(1 if prewarm_all(args.workers) else 0)
+
+    run_prewarm_loop(args.interval, args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,340 @@
+import asyncio
+import datetime
+import weakref
+from functools import partial
+import aiohttp
+from predicthq.exceptions import ClientError, ServerError
+import utils.predicthq as sync
+import utils.sidebar as sidebar
+from utils.cache import cached_async, run_single_flight_async, refresh_in_background
+from utils.settings import get_setting
+from utils.predicthq import (
+    get_api_key,
+    get_endpoint_name,
+    get_rate_limiter,
+    get_request_priority,
+    get_retry_delay,
+    get_dates_in_range,
+    group_consecutive_dates,
+    get_cached_feature_rows,
+    make_features_result,
+    set_feature_days,
+    get_demand_surge_window_from,
+    add_cached_demand_surge_window,
+    filter_demand_surges,
+    make_events_frame,
+    combine_events_pages,
+    filter_events,
+    ALL_CATEGORIES,
+    DEMAND_SURGE_WINDOW,
+    EVENTS_PAGE_SIZE,
+    MAX_EVENTS,
+    MAX_RADIUS,
+    MAX_RETRIES,
+    REQUEST_TIMEOUT,
+)
+
+API_URL = "https://api.predicthq.com"
+
+# Maximum number of requests in flight at once per event loop (can be changed with
+# `async_concurrency` in the secrets file)
+ASYNC_CONCURRENCY = 100
+
+# event loop -> (session, semaphore), aiohttp sessions can't be shared between loops
+_sessions = weakref.WeakKeyDictionary()
+
+
+def get_async_session():
+    """
+    One aiohttp session (and connection pool) per event loop, shared by every request
+    made from it, and a semaphore limiting how many requests are in flight at once.
+    Close it with close_async_session() before the loop ends.
+    """
+    loop = asyncio.get_running_loop()
+
+    if loop not in _sessions:
+        concurrency = int(get_setting("async_concurrency", ASYNC_CONCURRENCY))
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=concurrency)
+        )
+        _sessions[loop] = (session, asyncio.Semaphore(concurrency))
+
+    return _sessions[loop]
+
+
+async def close_async_session():
+    session, _ = _sessions.pop(asyncio.get_running_loop(), (None, None))
+
+    if session is not None:
+        await session.close()
+
+
+async def request(method, path, **kwargs):
+    """
+    The async version of send_request: requests share the rate limiters (and
+    priorities, see background_requests) of the synchronous calls, and are retried with
+    jitter if they're rate limited or fail on the server side. Returns the JSON response
+    and raises the SDK's ClientError or ServerError for error responses.
+    """
+    url = f"{API_URL}{path}"
+    rate_limiter = get_rate_limiter(get_endpoint_name(url))
+    session, semaphore = get_async_session()
+    max_retries = int(get_setting("max_retries", MAX_RETRIES))
+    timeout = aiohttp.ClientTimeout(
+        total=float(get_setting("request_timeout", REQUEST_TIMEOUT))
+    )
+    headers = {
+        "Authorization": f"Bearer {get_api_key()}",
+        "Accept": "application/json",
+    }
+
+    for attempt in range(max_retries + 1):
+        await rate_limiter.acquire_async(get_request_priority())
+
+        async with semaphore:
+            try:
+                async with session.request(
+                    method, url, headers=headers, timeout=timeout, **kwargs
+                ) as response:
+                    if (
+                        response.status != 429 and response.status < 500
+                    ) or attempt == max_retries:
+                        return await read_response(response)
+
+                    delay = get_retry_delay(response, attempt)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt == max_retries:
+                    raise
+
+                delay = get_retry_delay(None, attempt)
+
+        await asyncio.sleep(delay)
+
+
+async def read_response(response):
+    if response.status >= 400:
+        try:
+            error = await response.json(content_type=None)
+        except ValueError:
+            error = await response.read()
+
+        if response.status <= 499:
+            raise ClientError(error)
+        else:
+            raise ServerError(error)
+
+    try:
+        return await response.json(content_type=None) or None
+    except ValueError:
+        return None
+
+
+async def fetch_features(
+    lat, lon, radius, date_from, date_to, features=[], radius_unit="mi"
+):
+    # See utils.predicthq.fetch_features, the per-day cache is shared with it
+    location_key = (lat, lon, radius, radius_unit)
+    dates = get_dates_in_range(date_from, date_to)
+    rows, missing_dates, stale_dates = get_cached_feature_rows(
+        location_key, features, dates
+    )
+
+    fetched_rows = await asyncio.gather(
+        *[
+            run_single_flight_async(
+                "features",
+                (location_key, tuple(features), missing_from, missing_to),
+                partial(
+                    fetch_feature_days,
+                    lat,
+                    lon,
+                    radius,
+                    missing_from,
+                    missing_to,
+                    features,
+                    radius_unit,
+                ),
+            )
+            for missing_from, missing_to in group_consecutive_dates(missing_dates)
+        ]
+    )
+
+    for fetched in fetched_rows:
+        rows.update(fetched)
+
+    for stale_from, stale_to in group_consecutive_dates(stale_dates):
+        refresh_in_background(
+            "features",
+            (location_key, tuple(features), stale_from, stale_to),
+            partial(
+                sync.fetch_feature_days,
+                lat,
+                lon,
+                radius,
+                stale_from,
+                stale_to,
+                features,
+                radius_unit,
+            ),
+        )
+
+    return make_features_result(rows, dates, features)
+
+
+async def fetch_feature_days(
+    lat, lon, radius, date_from, date_to, features, radius_unit
+):
+    features_result = await request(
+        "post",
+        "/v1/features/",
+        json={
+            "location": {
+                "geo": {"lat": lat, "lon": lon, "radius": f"{radius}{radius_unit}"}
+            },
+            "active": {"gte": date_from.isoformat(), "lte": date_to.isoformat()},
+            **{feature: {"stats": ["sum", "count"]} for feature in features},
+        },
+    )
+
+    # Dates are returned as strings, the SDK (and the cache) uses dates
+    for item in features_result["results"]:
+        item["date"] = datetime.date.fromisoformat(item["date"])
+
+    return set_feature_days(
+        (lat, lon, radius, radius_unit), date_from, date_to, features, features_result
+    )
+
+
+async def fetch_events(
+    lat, lon, radius, date_from, date_to, tz="UTC", categories=[], radius_unit="mi"
+):
+    # See utils.predicthq.fetch_events, all the pages after the first are fetched at once
+    max_events = int(get_setting("max_events", MAX_EVENTS))
+    search_radius = radius
+
+    # Only search MAX_RADIUS when it returns all of its events, see
+    # utils.predicthq.get_events_search_radius
+    if get_setting("fetch_events_for_max_radius", False) and radius < MAX_RADIUS:
+        page = await search_events_page(
+            lat, lon, MAX_RADIUS, date_from, date_to, tz, radius_unit
+        )
+
+        if page["count"] <= max_events:
+            search_radius = MAX_RADIUS
+
+    search = partial(
+        search_events_page,
+        lat,
+        lon,
+        search_radius,
+        date_from,
+        date_to,
+        tz,
+        radius_unit,
+    )
+    page = await search()
+    total = min(page["count"], max_events)
+    pages = await asyncio.gather(
+        *[
+            search(offset=offset)
+            for offset in range(EVENTS_PAGE_SIZE, total, EVENTS_PAGE_SIZE)
+        ]
+    )
+
+    return filter_events(
+        combine_events_pages([page, *pages]).iloc[:total],
+        lat,
+        lon,
+        radius,
+        categories,
+        radius_unit,
+        search_radius=search_radius,
+    )
+
+
+@cached_async("events", sync.search_events_page)
+async def search_events_page(
+    lat, lon, radius, date_from, date_to, tz, radius_unit, offset=0
+):
+    events = await request(
+        "get",
+        "/v1/events/",
+        params={
+            "within": f"{radius}{radius_unit}@{lat},{lon}",
+            "active.gte": date_from.isoformat(),
+            "active.lte": date_to.isoformat(),
+            "active.tz": tz,
+            "category": ",".join(ALL_CATEGORIES),
+            "state": "active",
+            "limit": EVENTS_PAGE_SIZE,
+            "offset": offset,
+            "sort": "phq_attendance",
+        },
+    )
+
+    return {"count": events["count"], "events": make_events_frame(events["results"])}
+
+
+@cached_async("event_counts", sync.fetch_event_counts)
+async def fetch_event_counts(
+    lat, lon, radius, date_from, date_to, tz="UTC", radius_unit="mi"
+):
+    return await request(
+        "get",
+        "/v1/events/count/",
+        params={
+            "within": f"{radius}{radius_unit}@{lat},{lon}",
+            "active.gte": date_from.isoformat(),
+            "active.lte": date_to.isoformat(),
+            "active.tz": tz,
+            "state": "active",
+        },
+    )
+
+
+async def fetch_demand_surges(
+    lat, lon, radius, date_from, date_to, min_surge_intensity="m", radius_unit="mi"
+):
+    # See utils.predicthq.fetch_demand_surges, the 90d windows are shared with it
+    window_key = (lat, lon, radius, radius_unit, min_surge_intensity)
+    window_from = get_demand_surge_window_from(window_key, date_from, date_to)
+
+    surge_dates = await fetch_demand_surge_window(
+        lat, lon, radius, window_from, min_surge_intensity, radius_unit
+    )
+    add_cached_demand_surge_window(window_key, window_from)
+
+    return filter_demand_surges(surge_dates, date_from, date_to)
+
+
+@cached_async("demand_surge", sync.fetch_demand_surge_window)
+async def fetch_demand_surge_window(
+    lat, lon, radius, window_from, min_surge_intensity="m", radius_unit="mi"
+):
+    response = await request(
+        "get",
+        "/v1/demand-surge",
+        params={
+            "location.origin": f"{lat},{lon}",
+            "location.radius": f"{radius}{radius_unit}",
+            "date_from": window_from.isoformat(),
+            "date_to": (window_from + DEMAND_SURGE_WINDOW).isoformat(),
+            "min_surge_intensity": min_surge_intensity,
+        },
+        allow_redirects=False,
+    )
+
+    return response["surge_dates"]
+
+
+@cached_async("suggested_radius", sidebar.fetch_suggested_radius)
+async def fetch_suggested_radius(lat, lon, radius_unit="mi", industry="restaurants"):
+    return await request(
+        "get",
+        "/v1/suggested-radius/",
+        params={
+            "location.origin": f"{lat},{lon}",
+            "radius_unit": radius_unit,
+            "industry": industry,
+        },
+    )
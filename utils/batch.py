@@ -0,0 +1,140 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from utils.geo import calc_meters
+from utils.metrics import calc_metrics, calc_delta_pct
+from utils.planner import fetch_events_for_locations
+from utils.sidebar import get_date_options, get_radius_unit, fetch_suggested_radius
+from utils.settings import get_setting
+
+# Number of locations processed at a time, each of them makes 4 API calls at once
+BATCH_WORKERS = 8
+
+# Metrics with a previous period to compare with, the delta is added as <name>_delta_pct
+DELTA_METRICS = [
+    "phq_attendance_sum",
+    "average_daily_attendance",
+    "attended_events_sum",
+    "non_attended_events_sum",
+    "demand_surges_count",
+]
+
+logger = logging.getLogger(__name__)
+
+
+def read_locations(path):
+    """
+    Read restaurants from a CSV or Parquet file with `lat`, `lon` and `tz` columns, and
+    optionally `units` (imperial or metric, the default) and any other columns (e.g. an
+    id or name), which are copied to the results.
+    """
+    if str(path).endswith(".parquet"):
+        locations = pd.read_parquet(path)
+    else:
+        locations = pd.read_csv(path)
+
+    missing = {"lat", "lon", "tz"} - set(locations.columns)
+
+    if missing:
+        raise ValueError(f"Missing columns in {path}: {', '.join(sorted(missing))}")
+
+    if "units" not in locations.columns:
+        locations["units"] = "metric"
+
+    return locations.to_dict(orient="records")
+
+
+def calc_location_metrics(location, date_range="next_90_days"):
+    # The same metrics as show_metrics, at the location's suggested radius
+    date_option = next(
+        option for option in get_date_options(location) if option["id"] == date_range
+    )
+    suggested_radius = fetch_suggested_radius(
+        location["lat"], location["lon"], radius_unit=get_radius_unit(location)
+    )
+    radius = suggested_radius.get("radius", 2.0)
+    metrics = calc_metrics(
+        location, radius, date_option["date_from"], date_option["date_to"]
+    )
+
+    for name in DELTA_METRICS:
+        metrics[f"{name}_delta_pct"] = calc_delta_pct(
+            metrics[name], metrics[f"previous_{name}"]
+        )
+
+    return {
+        "radius": radius,
+        "radius_unit": suggested_radius["radius_unit"],
+        "date_from": date_option["date_from"],
+        "date_to": date_option["date_to"],
+        **metrics,
+    }
+
+
+def run_batch(locations, date_range="next_90_days", max_workers=None):
+    """
+    Calculate the metrics for every location with a bounded pool of workers, and return
+    them as a DataFrame with one row per location (in the same order). A location that
+    fails doesn't stop the batch, its error is kept in the `error` column.
+    """
+
+    def calc_row(location):
+        try:
+            return {**location, **calc_location_metrics(location, date_range)}
+        except Exception as e:
+            logger.exception("Failed to calculate metrics for %s", location)
+            return {**location, "error": str(e)}
+
+    with ThreadPoolExecutor(
+        max_workers=max_workers or int(get_setting("batch_workers", BATCH_WORKERS))
+    ) as executor:
+        rows = list(executor.map(calc_row, locations))
+
+    results = pd.DataFrame(rows)
+
+    if "error" not in results.columns:
+        results["error"] = None
+
+    return results
+
+
+def fetch_batch_events(results):
+    """
+    Fetch the events within each location's radius, for the date range of its metrics
+    (see run_batch), as a single frame with the location's row number in `location`.
+    Nearby locations share searches, see utils/planner.py. Locations that failed are
+    skipped.
+    """
+    results = results[results["error"].isna()]
+    locations = [
+        {
+            "lat": row.lat,
+            "lon": row.lon,
+            "tz": row.tz,
+            "date_from": row.date_from,
+            "date_to": row.date_to,
+            "radius_meters": calc_meters(row.radius, row.radius_unit),
+        }
+        for row in results.itertuples()
+    ]
+    events = fetch_events_for_locations(locations)
+
+    if not events:
+        return pd.DataFrame({"location": []})
+
+    # Geometries are nested GeoJSON, which doesn't fit a columnar file
+    return pd.concat(
+        [
+            location_events.drop(columns="geometry").assign(location=index)
+            for index, location_events in zip(results.index, events)
+        ],
+        ignore_index=True,
+    )
+
+
+def write_results(results, path):
+    # Parquet unless a CSV file is asked for
+    if str(path).endswith(".csv"):
+        results.to_csv(path, index=False)
+    else:
+        results.to_parquet(path, index=False)
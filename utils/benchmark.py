@@ -0,0 +1,564 @@
+import contextlib
+import datetime
+import json
+import math
+import platform
+import random
+import re
+import statistics
+import time
+from collections import Counter
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import pandas as pd
+import requests
+import streamlit as st
+from requests.adapters import HTTPAdapter
+from utils.cache import clear_cache
+from utils.features import (
+    make_features_matrix,
+    calc_period_totals,
+    calc_daily_sums,
+    calc_daily_sums_by_feature,
+)
+from utils.geo import calc_meters, EARTH_RADIUS_METERS
+from utils.map import show_map
+from utils.metrics import (
+    calc_metrics,
+    calc_previous_date_range,
+    show_location_metrics,
+)
+from utils.predicthq import (
+    get_http_session,
+    get_endpoint_name,
+    fetch_events,
+    fetch_features,
+    make_events_frame,
+    ALL_CATEGORIES,
+    ATTENDED_CATEGORIES,
+    PHQ_ATTENDANCE_FEATURES,
+)
+from utils.settings import override_settings
+from utils.sidebar import LOCATIONS
+
+API_URL = "https://api.predicthq.com/"
+
+# Number of events and of days in the date range the benchmarks are run with
+EVENT_SIZES = [10, 1000, 100000]
+DAY_COUNTS = [7, 30, 90, 365]
+
+# Number of times each benchmark is run, the min, median and max are reported
+REPEAT = 5
+
+# A benchmark is a regression when its median is this many times the baseline's
+REGRESSION_THRESHOLD = 1.2
+
+# Every benchmark is run at the first location, with this radius in its units
+BENCHMARK_RADIUS = 1.0
+
+# Settings used while benchmarking: no persistent cache, and rate limits high enough
+# that requests are never held up
+BENCHMARK_SETTINGS = {
+    "api_key": "benchmark",
+    "cache_path": None,
+    "show_timings": False,
+    "prewarm_interval": None,
+    "max_retries": 0,
+    "rate_limits": {
+        endpoint: {"rate": 1e9, "burst": 1e9}
+        for endpoint in [
+            "features",
+            "events",
+            "events_count",
+            "demand-surge",
+            "suggested-radius",
+        ]
+    },
+}
+
+
+class FakeAPIAdapter(HTTPAdapter):
+    """
+    A transport answering PredictHQ API requests without a network, mounted on the shared
+    session (see use_fake_api) so requests still go through the SDK, send_request and the
+    cache. Responses are synthetic, sized by `num_events`, unless a recorded response for
+    the endpoint is in `fixtures` (see read_fixtures). Recorded events are used as
+    templates for the `num_events` events returned.
+    """
+
+    def __init__(self, num_events=1000, fixtures=None, seed=0):
+        super().__init__()
+        self.num_events = num_events
+        self.fixtures = fixtures or {}
+        self.seed = seed
+        self.requests = Counter()
+        self._events = {}
+
+    def send(self, request, **kwargs):
+        endpoint = get_endpoint_name(request.url)
+        params = {
+            name: values[0]
+            for name, values in parse_qs(urlparse(request.url).query).items()
+        }
+        body = json.loads(request.body) if request.body else {}
+        self.requests[endpoint] += 1
+
+        if endpoint == "events":
+            data = self.search_events(params)
+        elif endpoint in self.fixtures:
+            data = self.fixtures[endpoint]
+        elif endpoint == "features":
+            data = make_fake_features(body)
+        elif endpoint == "events_count":
+            data = make_fake_event_counts(self.num_events)
+        elif endpoint == "demand-surge":
+            data = make_fake_demand_surges(params)
+        elif endpoint == "suggested-radius":
+            data = make_fake_suggested_radius(params)
+        else:
+            return make_response(
+                request, 404, {"error": f"Unknown endpoint {endpoint}"}
+            )
+
+        return make_response(request, 200, data)
+
+    def search_events(self, params):
+        # "1.0mi@37.7,-122.4"
+        radius, unit, lat, lon = re.match(
+            r"([\d.]+)([a-z]+)@([-\d.]+),([-\d.]+)", params["within"]
+        ).groups()
+        key = (
+            lat,
+            lon,
+            radius,
+            unit,
+            params["active.gte"],
+            params["active.lte"],
+            self.num_events,
+        )
+
+        # Every page of a search must come from the same events
+        if key not in self._events:
+            self._events[key] = make_fake_events(
+                self.num_events,
+                float(lat),
+                float(lon),
+                calc_meters(float(radius), unit),
+                datetime.date.fromisoformat(params["active.gte"]),
+                datetime.date.fromisoformat(params["active.lte"]),
+                templates=self.fixtures.get("events", {}).get("results"),
+                seed=self.seed,
+            )
+
+        events = self._events[key]
+        offset = int(params.get("offset", 0))
+
+        return {
+            "count": len(events),
+            "overflow": False,
+            "next": None,
+            "previous": None,
+            "results": events[offset : offset + int(params.get("limit", 10))],
+        }
+
+
+def make_response(request, status_code, data):
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers["Content-Type"] = "application/json"
+    response._content = json.dumps(data).encode("utf-8")
+    response.encoding = "utf-8"
+    response.url = request.url
+    response.request = request
+
+    return response
+
+
+@contextlib.contextmanager
+def use_fake_api(adapter):
+    # Send the PredictHQ API requests of the shared session to `adapter` inside the block
+    session = get_http_session()
+    session.mount(API_URL, adapter)
+
+    try:
+        yield adapter
+    finally:
+        session.adapters.pop(API_URL, None)
+
+
+def read_fixtures(path):
+    """
+    Recorded responses to replay, one `<endpoint>.json` file per endpoint in the folder
+    (features, events, events_count, demand-surge and suggested-radius), each holding the
+    JSON body of a response of that endpoint.
+    """
+    return {
+        file.stem: json.loads(file.read_text()) for file in Path(path).glob("*.json")
+    }
+
+
+def make_fake_events(
+    num_events, lat, lon, radius_meters, date_from, date_to, templates=None, seed=0
+):
+    """
+    Events in the API's JSON format, spread over the radius around (lat, lon) and the
+    date range. One in twenty is a polygon (e.g. a school holiday or severe weather)
+    reaching up to 20km, so the map has to clip and simplify them.
+    """
+    rng = random.Random(seed)
+    hours = max((date_to - date_from).days, 1) * 24
+    starts = datetime.datetime.combine(date_from, datetime.time())
+    events = []
+
+    for i in range(num_events):
+        # Uniformly spread over the circle
+        distance = radius_meters * 0.99 * math.sqrt(rng.random())
+        angle = rng.uniform(0, 2 * math.pi)
+        event_lat, event_lon = offset_position(
+            lat, lon, distance * math.sin(angle), distance * math.cos(angle)
+        )
+        start = starts + datetime.timedelta(hours=rng.randrange(hours))
+        end = start + datetime.timedelta(hours=rng.randint(1, 72))
+
+        if i % 20 == 0:
+            geometry = make_fake_polygon(event_lat, event_lon, rng.uniform(500, 20000))
+        else:
+            geometry = {"type": "Point", "coordinates": [event_lon, event_lat]}
+
+        if templates:
+            event = dict(templates[i % len(templates)])
+        else:
+            category = rng.choice(ALL_CATEGORIES)
+            event = {
+                "title": f"Event {i}",
+                "category": category,
+                "phq_attendance": (
+                    rng.randint(10, 50000) if category in ATTENDED_CATEGORIES else None
+                ),
+                "rank": rng.randint(0, 100),
+                "local_rank": rng.choice([None, rng.randint(0, 100)]),
+                "start": start.isoformat() + "Z",
+                "end": end.isoformat() + "Z",
+                "predicted_end": (
+                    (end + datetime.timedelta(hours=1)).isoformat() + "Z"
+                    if i % 2
+                    else None
+                ),
+                "timezone": rng.choice([None, "America/Los_Angeles", "Europe/London"]),
+                "entities": (
+                    [
+                        {
+                            "entity_id": f"venue-{i % 500}",
+                            "name": f"Venue {i % 500}",
+                            "type": "venue",
+                            "formatted_address": f"{i % 500} Main St",
+                        }
+                    ]
+                    if category in ATTENDED_CATEGORIES
+                    else []
+                ),
+            }
+
+        event.update(
+            {
+                "id": f"fake-{i}",
+                "location": [event_lon, event_lat],
+                "geo": {"geometry": geometry, "placekey": f"fake@{i % 1000}"},
+            }
+        )
+        events.append(event)
+
+    return events
+
+
+def make_fake_polygon(lat, lon, radius_meters, num_points=64):
+    angles = np.linspace(0, 2 * np.pi, num_points)
+    lats, lons = offset_position(
+        lat, lon, radius_meters * np.sin(angles), radius_meters * np.cos(angles)
+    )
+
+    return {
+        "type": "Polygon",
+        "coordinates": [np.column_stack([lons, lats]).round(6).tolist()],
+    }
+
+
+def offset_position(lat, lon, north_meters, east_meters):
+    scale = np.pi * EARTH_RADIUS_METERS / 180
+
+    return (
+        lat + north_meters / scale,
+        lon + east_meters / (scale * np.cos(np.radians(lat))),
+    )
+
+
+def make_fake_features(body):
+    date_from = datetime.date.fromisoformat(body["active"]["gte"])
+    date_to = datetime.date.fromisoformat(body["active"]["lte"])
+    features = [name for name in body if name.startswith("phq_")]
+    results = []
+
+    for i in range((date_to - date_from).days + 1):
+        date = date_from + datetime.timedelta(days=i)
+        # The same values for the same day, whatever the range asked for
+        rng = random.Random(date.toordinal())
+        results.append(
+            {
+                "date": date.isoformat(),
+                **{
+                    feature: {
+                        "stats": {
+                            "sum": float(rng.randint(0, 20000)),
+                            "count": rng.randint(0, 40),
+                        }
+                    }
+                    for feature in features
+                },
+            }
+        )
+
+    return {"count": len(results), "results": results}
+
+
+def make_fake_event_counts(num_events):
+    rng = random.Random(num_events)
+    categories = Counter(
+        rng.choice(ALL_CATEGORIES) for _ in range(min(num_events, 1000))
+    )
+
+    return {
+        "count": num_events,
+        "top_rank": 100.0,
+        "rank_levels": {str(level): num_events // 5 for level in range(1, 6)},
+        "categories": {
+            category: count * num_events // min(num_events, 1000)
+            for category, count in categories.items()
+        },
+        "labels": {},
+    }
+
+
+def make_fake_demand_surges(params):
+    date_from = datetime.date.fromisoformat(params["date_from"])
+    date_to = datetime.date.fromisoformat(params["date_to"])
+    surge_dates = [
+        {
+            "date": (date_from + datetime.timedelta(days=day)).isoformat(),
+            "phq_attendance_sum": 200000,
+        }
+        for day in range(3, (date_to - date_from).days + 1, 11)
+    ]
+
+    return {"count": len(surge_dates), "surge_dates": surge_dates}
+
+
+def make_fake_suggested_radius(params):
+    lat, lon = params["location.origin"].split(",")
+
+    return {
+        "radius": BENCHMARK_RADIUS,
+        "radius_unit": params.get("radius_unit", "mi"),
+        "location": {"lat": float(lat), "lon": float(lon)},
+    }
+
+
+def time_call(func, repeat=REPEAT, setup=None):
+    # Wall time of `func` in seconds, `setup` (e.g. clearing the cache) isn't timed
+    times = []
+
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+
+        started = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - started)
+
+    return {
+        "repeat": repeat,
+        "min": min(times),
+        "median": statistics.median(times),
+        "max": max(times),
+    }
+
+
+def run_benchmarks(
+    event_sizes=EVENT_SIZES, day_counts=DAY_COUNTS, repeat=REPEAT, fixtures=None
+):
+    """
+    Time the data and rendering paths of the pages against the fake API, and return the
+    results in a JSON-friendly dict (see compare_results). `cold` benchmarks start from
+    an empty cache, so they include the requests and parsing of the responses.
+
+    The Features API aggregation used to be done by calc_sum_of_features,
+    calc_daily_sum_of_features and get_daily_sums_of_features, it's now done by the
+    functions in utils/features.py, which are what's timed here.
+    """
+    adapter = FakeAPIAdapter(fixtures=fixtures)
+    results = []
+
+    with override_settings(**BENCHMARK_SETTINGS), use_fake_api(adapter):
+        for days in day_counts:
+            results += run_features_benchmarks(days, repeat)
+
+        for num_events in event_sizes:
+            adapter.num_events = num_events
+            results += run_events_benchmarks(
+                num_events,
+                repeat,
+                templates=adapter.fixtures.get("events", {}).get("results"),
+            )
+
+    return {
+        "created": datetime.datetime.utcnow().isoformat() + "Z",
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "streamlit": st.__version__,
+        "repeat": repeat,
+        "fixtures": sorted(fixtures or {}),
+        "results": results,
+    }
+
+
+def run_features_benchmarks(days, repeat):
+    location = LOCATIONS[0]
+    date_from = datetime.date(2023, 1, 1)
+    date_to = date_from + datetime.timedelta(days=days)
+    previous_date_from, previous_date_to = calc_previous_date_range(date_from, date_to)
+
+    def fetch():
+        return fetch_features(
+            location["lat"],
+            location["lon"],
+            BENCHMARK_RADIUS,
+            date_from=previous_date_from,
+            date_to=date_to,
+            features=PHQ_ATTENDANCE_FEATURES,
+        )
+
+    features_result = fetch()
+    matrix = make_features_matrix(features_result, PHQ_ATTENDANCE_FEATURES)
+    benchmarks = {
+        "fetch_features (cold)": (fetch, clear_cache),
+        "fetch_features (warm)": (fetch, None),
+        "make_features_matrix": (
+            lambda: make_features_matrix(features_result, PHQ_ATTENDANCE_FEATURES),
+            None,
+        ),
+        "calc_period_totals": (
+            lambda: calc_period_totals(
+                matrix, date_from, date_to, previous_date_from, previous_date_to
+            ),
+            None,
+        ),
+        "calc_daily_sums": (lambda: calc_daily_sums(matrix), None),
+        "calc_daily_sums_by_feature": (
+            lambda: calc_daily_sums_by_feature(matrix),
+            None,
+        ),
+        "calc_metrics (cold)": (
+            lambda: calc_metrics(location, BENCHMARK_RADIUS, date_from, date_to),
+            clear_cache,
+        ),
+        "calc_metrics (warm)": (
+            lambda: calc_metrics(location, BENCHMARK_RADIUS, date_from, date_to),
+            None,
+        ),
+        # show_metrics itself reads the sidebar options from the session state, which
+        # only works under `streamlit run`
+        "show_metrics (warm)": (
+            lambda: show_location_metrics(
+                location,
+                {"radius": BENCHMARK_RADIUS, "radius_unit": "mi"},
+                BENCHMARK_RADIUS,
+                date_from,
+                date_to,
+            ),
+            None,
+        ),
+    }
+
+    return [
+        {"name": name, "days": days, **time_call(func, repeat, setup)}
+        for name, (func, setup) in benchmarks.items()
+    ]
+
+
+def run_events_benchmarks(num_events, repeat, templates=None):
+    # The page's module is named map, so it's imported here rather than at the top
+    from map import show_events_list
+
+    location = LOCATIONS[0]
+    date_from = datetime.date(2023, 1, 1)
+    date_to = date_from + datetime.timedelta(days=90)
+    radius_meters = calc_meters(BENCHMARK_RADIUS, "mi")
+
+    def fetch():
+        return fetch_events(
+            location["lat"],
+            location["lon"],
+            BENCHMARK_RADIUS,
+            date_from=date_from,
+            date_to=date_to,
+            tz=location["tz"],
+            categories=ALL_CATEGORIES,
+        )
+
+    # The page never fetches more than `max_events`, so the rendering benchmarks are run
+    # with all the events built straight from the (fake) API's JSON
+    raw_events = make_fake_events(
+        num_events,
+        location["lat"],
+        location["lon"],
+        radius_meters,
+        date_from,
+        date_to,
+        templates=templates,
+    )
+    events = make_events_frame(raw_events)
+
+    # The fake API makes up the events of a search the first time it's asked for them
+    fetch()
+
+    benchmarks = {
+        "fetch_events (cold)": (fetch, clear_cache),
+        "fetch_events (warm)": (fetch, None),
+        "make_events_frame": (lambda: make_events_frame(raw_events), None),
+        "show_events_list": (
+            lambda: show_events_list(events, show_download=False),
+            None,
+        ),
+        "show_map (cold)": (
+            lambda: show_map(location["lat"], location["lon"], radius_meters, events),
+            clear_cache,
+        ),
+        "show_map (warm)": (
+            lambda: show_map(location["lat"], location["lon"], radius_meters, events),
+            None,
+        ),
+    }
+
+    return [
+        {"name": name, "events": num_events, **time_call(func, repeat, setup)}
+        for name, (func, setup) in benchmarks.items()
+    ]
+
+
+def compare_results(baseline, results, threshold=REGRESSION_THRESHOLD):
+    """
+    Compare the medians of two run_benchmarks results. Returns a DataFrame with one row
+    per benchmark in both, and whether it's a regression (`ratio` above `threshold`).
+    """
+    columns = ["name", "days", "events"]
+    merged = pd.merge(
+        pd.DataFrame(baseline["results"]).reindex(columns=columns + ["median"]),
+        pd.DataFrame(results["results"]).reindex(columns=columns + ["median"]),
+        on=columns,
+        suffixes=("_baseline", ""),
+    )
+    merged["ratio"] = merged["median"] / merged["median_baseline"]
+    merged["regression"] = merged["ratio"] > threshold
+
+    return merged
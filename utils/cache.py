@@ -0,0 +1,605 @@
+import asyncio
+import contextlib
+import contextvars
+import functools
+import hashlib
+import inspect
+import logging
+import pickle
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from utils.settings import get_setting
+from utils.disk_cache import disk_cache_get_many, disk_cache_set_many
+
+MB = 1024 * 1024
+
+# Cache policy per endpoint: how long entries are fresh (seconds), how long past that an
+# expired entry may still be served while it's refreshed in the background (seconds, 0 to
+# always wait for a refresh), and how many entries and bytes (pickled size) the cache may
+# hold before the least recently used entries are evicted. Each value can be overridden
+# in the secrets file, e.g.
+#
+#   [cache.events]
+#   ttl = 1800
+#   max_bytes = 134217728
+CACHE_POLICIES = {
+    # Features are cached per day, so there are many small entries
+    "features": {
+        "ttl": 6 * 60 * 60,
+        "max_staleness": 24 * 60 * 60,
+        "max_entries": 200000,
+        "max_bytes": 64 * MB,
+    },
+    # Parsed features (see utils/features.py), kept fresh for less time than the days
+    # they're built from so refreshed days show up soon
+    "features_matrix": {
+        "ttl": 60 * 60,
+        "max_staleness": 24 * 60 * 60,
+        "max_entries": 5000,
+        "max_bytes": 64 * MB,
+    },
+    "events": {
+        "ttl": 60 * 60,
+        "max_staleness": 6 * 60 * 60,
+        "max_entries": 2000,
+        "max_bytes": 256 * MB,
+    },
+    "event_counts": {
+        "ttl": 60 * 60,
+        "max_staleness": 6 * 60 * 60,
+        "max_entries": 5000,
+        "max_bytes": 16 * MB,
+    },
+    "demand_surge": {
+        "ttl": 6 * 60 * 60,
+        "max_staleness": 24 * 60 * 60,
+        "max_entries": 5000,
+        "max_bytes": 16 * MB,
+    },
+    # Simplified polygons, per event and radius (see utils/map.py)
+    "event_geometry": {
+        "ttl": 60 * 60,
+        "max_staleness": 6 * 60 * 60,
+        "max_entries": 20000,
+        "max_bytes": 64 * MB,
+    },
+    "suggested_radius": {
+        "ttl": 24 * 60 * 60,
+        "max_staleness": 7 * 24 * 60 * 60,
+        "max_entries": 5000,
+        "max_bytes": 4 * MB,
+    },
+}
+
+# Number of threads refreshing stale entries in the background
+REFRESH_WORKERS = 4
+
+# endpoint -> key -> (created, pickled value), least recently used first
+_entries = defaultdict(OrderedDict)
+_sizes = Counter()
+_stats = defaultdict(Counter)
+_policies = {}
+_in_flight = {}
+_async_in_flight = {}
+# (endpoint, key) of the refreshes submitted and not finished yet
+_refreshing = set()
+_lock = threading.Lock()
+_refresh_executor = ThreadPoolExecutor(max_workers=REFRESH_WORKERS)
+
+# Entries served in the current context, see track_served_entries
+_served = contextvars.ContextVar("served_cache_entries", default=None)
+
+# Cache lookups made in the current context, see track_cache_lookups
+_lookups = contextvars.ContextVar("cache_lookups", default=None)
+
+logger = logging.getLogger(__name__)
+
+
+def cached(endpoint):
+    """
+    Cache the results of a function using the endpoint's cache policy (see CACHE_POLICIES).
+
+    This works like st.cache_data: values are pickled, so every caller gets its own copy,
+    and arguments starting with an underscore are not part of the cache key. Expired
+    values are served until they're older than the policy's max_staleness while they're
+    refreshed in the background (stale-while-revalidate).
+    """
+
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = make_cache_key(func, signature, args, kwargs)
+            entry = cache_get_entries(endpoint, [key]).get(key)
+
+            def fetch():
+                value = func(*args, **kwargs)
+                cache_set(endpoint, key, value)
+                return value
+
+            def lookup():
+                found = cache_peek_entries(endpoint, [key])
+                return (key in found, found.get(key))
+
+            if entry is None:
+                return run_single_flight(endpoint, key, fetch, lookup)
+
+            created, value, is_stale = entry
+
+            if is_stale:
+                refresh_in_background(endpoint, key, fetch)
+
+            return value
+
+        return wrapper
+
+    return decorator
+
+
+def cached_async(endpoint, sync_func):
+    """
+    Like cached, for a coroutine function that does the same as `sync_func` (a function
+    decorated with cached for the same endpoint and with the same arguments). Both share
+    the same cache entries, and expired entries are refreshed in the background by
+    calling `sync_func` from a thread.
+    """
+    # The undecorated function, cache keys are made from it
+    sync_func = inspect.unwrap(sync_func)
+    signature = inspect.signature(sync_func)
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            key = make_cache_key(sync_func, signature, args, kwargs)
+            entry = cache_get_entries(endpoint, [key]).get(key)
+
+            if entry is None:
+
+                async def fetch():
+                    value = await func(*args, **kwargs)
+                    cache_set(endpoint, key, value)
+                    return value
+
+                return await run_single_flight_async(endpoint, key, fetch)
+
+            created, value, is_stale = entry
+
+            if is_stale:
+
+                def refresh():
+                    value = sync_func(*args, **kwargs)
+                    cache_set(endpoint, key, value)
+                    return value
+
+                refresh_in_background(endpoint, key, refresh)
+
+            return value
+
+        return wrapper
+
+    return decorator
+
+
+async def run_single_flight_async(endpoint, key, func):
+    # Same as run_single_flight for coroutines, calls are shared within an event loop
+    in_flight_key = (asyncio.get_running_loop(), endpoint, key)
+    task = _async_in_flight.get(in_flight_key)
+
+    if task is not None:
+        with _lock:
+            _stats[endpoint]["coalesced"] += 1
+
+        return pickle.loads(pickle.dumps(await asyncio.shield(task)))
+
+    task = _async_in_flight[in_flight_key] = asyncio.ensure_future(func())
+
+    try:
+        return await asyncio.shield(task)
+    finally:
+        _async_in_flight.pop(in_flight_key, None)
+
+
+def run_single_flight(endpoint, key, func, lookup=None):
+    """
+    Make sure only one call for the same key is in flight at a time. When several sessions
+    ask for the same data at once (e.g. right after it expired), the first one calls the
+    API and the others wait for it and get (a copy of) the same result, or its exception.
+
+    A caller that missed the cache may only get here after the previous call stored the
+    value and finished, so `lookup`, if given, is called before `func` and returns a
+    (found, value) tuple, to use the value that's now in the cache instead.
+    """
+    with _lock:
+        future = _in_flight.get((endpoint, key))
+        is_leader = future is None
+
+        if is_leader:
+            future = _in_flight[(endpoint, key)] = Future()
+        else:
+            _stats[endpoint]["coalesced"] += 1
+
+    if not is_leader:
+        return pickle.loads(pickle.dumps(future.result()))
+
+    try:
+        found, value = lookup() if lookup is not None else (False, None)
+
+        if not found:
+            value = func()
+
+        future.set_result(value)
+        return value
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _lock:
+            del _in_flight[(endpoint, key)]
+
+
+def refresh_in_background(endpoint, key, func):
+    # Refresh a stale entry, unless it's already being fetched or waiting to be
+    with _lock:
+        if (endpoint, key) in _in_flight or (endpoint, key) in _refreshing:
+            return
+
+        _refreshing.add((endpoint, key))
+
+    def refresh():
+        # Imported here as utils.predicthq depends on this module
+        from utils.predicthq import background_requests
+
+        try:
+            # Refreshes don't hold up the requests of people using the app
+            with background_requests():
+                run_single_flight(endpoint, key, func)
+        except Exception:
+            # The stale value keeps being served until it's too old, then callers will
+            # fetch it themselves and see the error
+            logger.exception("Background refresh failed for %s", endpoint)
+        finally:
+            with _lock:
+                _refreshing.discard((endpoint, key))
+
+    _refresh_executor.submit(refresh)
+
+
+def make_cache_key(func, signature, args, kwargs):
+    arguments = signature.bind(*args, **kwargs)
+    arguments.apply_defaults()
+    params = [
+        (name, value)
+        for name, value in arguments.arguments.items()
+        if not name.startswith("_")
+    ]
+
+    return hashlib.sha256(
+        pickle.dumps((func.__module__, func.__qualname__, params))
+    ).hexdigest()
+
+
+def get_cache_policy(endpoint):
+    if endpoint not in _policies:
+        policy = dict(CACHE_POLICIES[endpoint])
+        policy.update(get_setting("cache", {}).get(endpoint, {}))
+        _policies[endpoint] = policy
+
+    return _policies[endpoint]
+
+
+def get_max_age(policy):
+    # Oldest an entry can be and still be served (stale)
+    if policy["ttl"] is None:
+        return None
+
+    return policy["ttl"] + (policy.get("max_staleness") or 0)
+
+
+def cache_get_entries(endpoint, keys):
+    """
+    Returns {key: (created, value, is_stale)} for the keys that can be served from the
+    cache. Keys that aren't in memory are looked up in the persistent cache (if enabled,
+    see utils/disk_cache.py) and kept in memory from then on.
+    """
+    started = time.perf_counter()
+    policy = get_cache_policy(endpoint)
+    ttl, max_age = policy["ttl"], get_max_age(policy)
+    now = time.time()
+    found = {}
+    missing = []
+
+    with _lock:
+        entries = _entries[endpoint]
+        stats = _stats[endpoint]
+
+        for key in keys:
+            entry = entries.get(key)
+
+            if entry is not None and max_age is not None and now - entry[0] > max_age:
+                remove_entry(endpoint, key)
+                stats["expirations"] += 1
+                entry = None
+
+            if entry is None:
+                missing.append(key)
+            else:
+                entries.move_to_end(key)
+                stats["hits"] += 1
+                found[key] = entry
+
+    if missing:
+        on_disk = disk_cache_get_many(endpoint, missing, max_age)
+        store_entries(endpoint, on_disk)
+
+        with _lock:
+            stats["hits"] += len(on_disk)
+            stats["disk_hits"] += len(on_disk)
+            stats["misses"] += len(missing) - len(on_disk)
+
+        found.update(on_disk)
+
+    results = {
+        key: (created, data, ttl is not None and now - created > ttl)
+        for key, (created, data) in found.items()
+    }
+
+    if results:
+        with _lock:
+            stats["stale_hits"] += sum(is_stale for _, _, is_stale in results.values())
+
+        record_served(
+            endpoint,
+            min(created for created, _, _ in results.values()),
+            any(is_stale for _, _, is_stale in results.values()),
+        )
+
+    # Unpickle outside the lock, it's the slow part
+    values = {
+        key: (created, pickle.loads(data), is_stale)
+        for key, (created, data, is_stale) in results.items()
+    }
+    record_lookup(
+        endpoint, len(values), len(keys) - len(values), time.perf_counter() - started
+    )
+
+    return values
+
+
+def cache_peek_entries(endpoint, keys):
+    """
+    Returns {key: value} for the keys kept in memory that can still be served, without
+    counting hits or misses or looking in the persistent cache. Used to check again for
+    a value that was only just stored, see run_single_flight.
+    """
+    max_age = get_max_age(get_cache_policy(endpoint))
+    now = time.time()
+
+    with _lock:
+        entries = _entries[endpoint]
+        found = {
+            key: entries[key][1]
+            for key in keys
+            if key in entries and (max_age is None or now - entries[key][0] <= max_age)
+        }
+
+    return {key: pickle.loads(data) for key, data in found.items()}
+
+
+def cache_set(endpoint, key, value):
+    cache_set_many(endpoint, {key: value})
+
+
+def cache_set_many(endpoint, values):
+    now = time.time()
+    entries = {
+        key: (now, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        for key, value in values.items()
+    }
+
+    store_entries(endpoint, entries)
+    disk_cache_set_many(endpoint, entries, get_max_age(get_cache_policy(endpoint)))
+
+
+def store_entries(endpoint, new_entries):
+    # `new_entries` is {key: (created, pickled value)}
+    policy = get_cache_policy(endpoint)
+
+    with _lock:
+        entries = _entries[endpoint]
+
+        for key, (created, data) in new_entries.items():
+            if key in entries:
+                remove_entry(endpoint, key)
+
+            # A value bigger than the whole cache would only evict everything else
+            if len(data) > policy["max_bytes"]:
+                continue
+
+            entries[key] = (created, data)
+            _sizes[endpoint] += len(data)
+
+        # Evict the least recently used entries until we're within the limits again
+        while entries and (
+            len(entries) > policy["max_entries"]
+            or _sizes[endpoint] > policy["max_bytes"]
+        ):
+            remove_entry(endpoint, next(iter(entries)))
+            _stats[endpoint]["evictions"] += 1
+
+
+def remove_entry(endpoint, key):
+    # Must be called while holding the lock
+    _, data = _entries[endpoint].pop(key)
+    _sizes[endpoint] -= len(data)
+
+
+def clear_cache():
+    # Drop every entry kept in memory (not the persistent cache), e.g. to measure cold runs
+    with _lock:
+        _entries.clear()
+        _sizes.clear()
+
+
+def get_cache_stats():
+    # Hit/miss/eviction counters and current size per endpoint, to help size the policies
+    with _lock:
+        return {
+            endpoint: {
+                "hits": _stats[endpoint]["hits"],
+                "disk_hits": _stats[endpoint]["disk_hits"],
+                "stale_hits": _stats[endpoint]["stale_hits"],
+                "misses": _stats[endpoint]["misses"],
+                "evictions": _stats[endpoint]["evictions"],
+                "expirations": _stats[endpoint]["expirations"],
+                "coalesced": _stats[endpoint]["coalesced"],
+                "entries": len(_entries[endpoint]),
+                "bytes": _sizes[endpoint],
+            }
+            for endpoint in CACHE_POLICIES
+        }
+
+
+def get_cached_feature_days(location_key, features, dates):
+    """
+    Features API rows are cached per (location, radius, feature, date). Shorter date ranges
+    are subsets of longer ones, so caching per day lets every range share the same rows.
+    Returns {(feature, date): (stats, is_stale)} for the days we already have.
+    """
+    keys = {
+        make_feature_day_key(location_key, feature, date): (feature, date)
+        for feature in features
+        for date in dates
+    }
+    found = cache_get_entries("features", keys)
+
+    return {keys[key]: (stats, is_stale) for key, (_, stats, is_stale) in found.items()}
+
+
+def peek_cached_feature_days(location_key, features, dates):
+    # Like get_cached_feature_days, without counting the lookup, see cache_peek_entries
+    keys = {
+        make_feature_day_key(location_key, feature, date): (feature, date)
+        for feature in features
+        for date in dates
+    }
+    found = cache_peek_entries("features", keys)
+
+    return {keys[key]: stats for key, stats in found.items()}
+
+
+def set_cached_feature_days(location_key, rows):
+    # `rows` is {(feature, date): stats}
+    cache_set_many(
+        "features",
+        {
+            make_feature_day_key(location_key, feature, date): stats
+            for (feature, date), stats in rows.items()
+        },
+    )
+
+
+def make_feature_day_key(location_key, feature, date):
+    return f"{location_key}|{feature}|{date}"
+
+
+# Start dates of the 90 day Demand Surge windows fetched per (origin, radius, intensity)
+# are kept in the demand_surge cache too, so they're bounded by the same policy
+_demand_surge_windows_lock = threading.Lock()
+
+
+def get_cached_demand_surge_windows(window_key):
+    key = make_demand_surge_windows_key(window_key)
+    entry = cache_get_entries("demand_surge", [key]).get(key)
+
+    return sorted(drop_expired_demand_surge_windows(entry[1] if entry else {}))
+
+
+def add_cached_demand_surge_window(window_key, window_from):
+    key = make_demand_surge_windows_key(window_key)
+
+    with _demand_surge_windows_lock:
+        added = drop_expired_demand_surge_windows(
+            cache_peek_entries("demand_surge", [key]).get(key, {})
+        )
+
+        # Most calls reuse a window we already have, don't store the same list again
+        if window_from in added:
+            return
+
+        added[window_from] = time.time()
+        cache_set("demand_surge", key, added)
+
+
+def drop_expired_demand_surge_windows(added):
+    # `added` is {window_from: added}, drop the windows whose data is too old to be served
+    max_age = get_max_age(get_cache_policy("demand_surge"))
+    now = time.time()
+
+    return {
+        window_from: window_added
+        for window_from, window_added in added.items()
+        if max_age is None or now - window_added <= max_age
+    }
+
+
+def make_demand_surge_windows_key(window_key):
+    return f"windows|{window_key}"
+
+
+@contextlib.contextmanager
+def track_served_entries():
+    """
+    Collect the age of the cached data served inside the block (including calls made by
+    run_in_parallel), e.g. to show how old the data on the page is:
+
+        with track_served_entries() as served:
+            ...
+        oldest = min(entry["created"] for entry in served)
+    """
+    served = []
+    token = _served.set(served)
+
+    try:
+        yield served
+    finally:
+        _served.reset(token)
+
+
+def record_served(endpoint, created, is_stale):
+    served = _served.get()
+
+    if served is not None:
+        served.append({"endpoint": endpoint, "created": created, "stale": is_stale})
+
+
+@contextlib.contextmanager
+def track_cache_lookups():
+    """
+    Collect the cache lookups made inside the block (including calls made by
+    run_in_parallel), each a dict with the `endpoint`, the number of `hits` and `misses`
+    and the `seconds` spent looking them up and unpickling them. Lookups made in a nested
+    block are also added to the outer one.
+    """
+    lookups = []
+    token = _lookups.set(lookups)
+
+    try:
+        yield lookups
+    finally:
+        _lookups.reset(token)
+        outer = _lookups.get()
+
+        if outer is not None:
+            outer.extend(lookups)
+
+
+def record_lookup(endpoint, hits, misses, seconds):
+    lookups = _lookups.get()
+
+    if lookups is not None:
+        lookups.append(
+            {"endpoint": endpoint, "hits": hits, "misses": misses, "seconds": seconds}
+        )
@@ -0,0 +1,115 @@
+import os
+import sqlite3
+import threading
+import time
+from utils.settings import get_setting
+
+# How long to wait for another process holding a write lock on the database (seconds)
+BUSY_TIMEOUT = 30
+
+# How often expired rows are deleted from the database (seconds)
+PURGE_INTERVAL = 60 * 60
+
+_local = threading.local()
+_last_purge = {}
+
+
+def get_disk_cache_path():
+    """
+    The persistent cache is optional and enabled by setting `cache_path` in the secrets
+    file. It's a SQLite database, so any number of processes on the same host (app
+    replicas, the pre-warmer, batch jobs) can read and write it at the same time.
+    """
+    return get_setting("cache_path", None)
+
+
+def get_connection(path):
+    # SQLite connections can't be shared between threads, so keep one per thread
+    connections = getattr(_local, "connections", None)
+
+    if connections is None:
+        connections = _local.connections = {}
+
+    if path not in connections:
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT)
+        # WAL lets readers carry on while another process is writing
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS cache (
+                endpoint TEXT NOT NULL,
+                key TEXT NOT NULL,
+                created REAL NOT NULL,
+                value BLOB NOT NULL,
+                PRIMARY KEY (endpoint, key)
+            )
+            """
+        )
+        connections[path] = connection
+
+    return connections[path]
+
+
+def disk_cache_get_many(endpoint, keys, max_age=None):
+    # Returns {key: (created, pickled value)} for the keys with a row on disk that isn't
+    # older than max_age (seconds)
+    path = get_disk_cache_path()
+
+    if path is None or not keys:
+        return {}
+
+    connection = get_connection(path)
+    min_created = time.time() - max_age if max_age is not None else 0
+    keys = list(keys)
+    found = {}
+
+    # Stay well below SQLite's limit on the number of query parameters
+    for i in range(0, len(keys), 500):
+        chunk = keys[i : i + 500]
+        rows = connection.execute(
+            f"""
+            SELECT key, created, value FROM cache
+            WHERE endpoint = ? AND created >= ? AND key IN ({",".join("?" * len(chunk))})
+            """,
+            [endpoint, min_created, *chunk],
+        )
+
+        for key, created, value in rows:
+            found[key] = (created, value)
+
+    return found
+
+
+def disk_cache_set_many(endpoint, entries, max_age=None):
+    # `entries` is {key: (created, pickled value)}
+    path = get_disk_cache_path()
+
+    if path is None or not entries:
+        return
+
+    connection = get_connection(path)
+
+    with connection:
+        connection.executemany(
+            "INSERT OR REPLACE INTO cache (endpoint, key, created, value) VALUES (?, ?, ?, ?)",
+            [
+                (endpoint, key, created, value)
+                for key, (created, value) in entries.items()
+            ],
+        )
+
+    if (
+        max_age is not None
+        and time.time() - _last_purge.get(endpoint, 0) > PURGE_INTERVAL
+    ):
+        _last_purge[endpoint] = time.time()
+
+        with connection:
+            connection.execute(
+                "DELETE FROM cache WHERE endpoint = ? AND created < ?",
+                [endpoint, time.time() - max_age],
+            )
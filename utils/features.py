@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+from utils.cache import cached
+from utils.predicthq import fetch_features
+from utils.timings import timed
+
+
+@timed("fetch_features_matrix")
+@cached("features_matrix")
+def fetch_features_matrix(
+    lat, lon, radius, date_from, date_to, features=[], radius_unit="mi", stat="sum"
+):
+    """
+    fetch_features parsed with make_features_matrix. The matrix is cached too, so the
+    metrics and the charts using the same features result (e.g. on the Demand Surge
+    page) share one parse instead of walking the result again on every rerun.
+    """
+    return make_features_matrix(
+        fetch_features(lat, lon, radius, date_from, date_to, features, radius_unit),
+        features,
+        stat,
+    )
+
+
+def make_features_matrix(features_result, features, stat="sum"):
+    """
+    Parse a Features API result into a date x feature DataFrame of the given stat, with
+    one row per date and one column per feature. Features missing on a date count as 0.
+
+    All the totals and daily sums below are computed from this matrix, so the result only
+    needs to be walked once.
+    """
+    results = features_result["results"]
+    values = np.zeros((len(results), len(features)))
+
+    for i, item in enumerate(results):
+        for j, feature in enumerate(features):
+            if feature in item:
+                values[i, j] = item[feature]["stats"][stat]
+
+    return pd.DataFrame(
+        values,
+        index=pd.DatetimeIndex([item["date"] for item in results], name="date"),
+        columns=features,
+    )
+
+
+def filter_dates(matrix, date_from=None, date_to=None):
+    # Keep only the rows inside the date range (both ends included)
+    start = pd.Timestamp(date_from) if date_from is not None else None
+    end = pd.Timestamp(date_to) if date_to is not None else None
+
+    return matrix.loc[start:end]
+
+
+def calc_total(matrix, date_from=None, date_to=None):
+    # Sum of all the features (optionally only within a date range)
+    return float(filter_dates(matrix, date_from, date_to).to_numpy().sum())
+
+
+def calc_period_totals(
+    matrix, date_from, date_to, previous_date_from, previous_date_to
+):
+    # Totals for the current and previous periods, for delta comparisons
+    return (
+        calc_total(matrix, date_from, date_to),
+        calc_total(matrix, previous_date_from, previous_date_to),
+    )
+
+
+def calc_daily_sums(matrix, name="phq_attendance_sum"):
+    # Sum of all the features per date, as a frame with `date` and `name` columns
+    return pd.DataFrame(
+        {"date": matrix.index, name: matrix.to_numpy().sum(axis=1)}
+    ).reset_index(drop=True)
+
+
+def calc_daily_sums_by_feature(matrix, name="phq_attendance_sum"):
+    # Long format frame with `date`, `feature` and `name` columns, e.g. for stacked charts
+    return matrix.reset_index().melt(
+        id_vars="date", var_name="feature", value_name=name
+    )
@@ -0,0 +1,165 @@
+import numpy as np
+
+# Mean radius of the earth
+EARTH_RADIUS_METERS = 6371008.8
+
+
+def calc_meters(value, unit):
+    if unit == "mi":
+        return value * 1609
+    if unit == "ft":
+        return value * 0.3048
+    elif unit == "km":
+        return value * 1000
+    else:
+        return value
+
+
+def calc_haversine_distances(lat, lon, lats, lons):
+    # Great-circle distance in meters from (lat, lon) to each of the points in lats/lons
+    lat1, lon1 = np.radians(lat), np.radians(lon)
+    lat2, lon2 = np.radians(np.asarray(lats, dtype=float)), np.radians(
+        np.asarray(lons, dtype=float)
+    )
+
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+
+    return 2 * EARTH_RADIUS_METERS * np.arcsin(np.sqrt(a))
+
+
+def calc_meters_per_pixel(lat, zoom):
+    # Ground resolution of a web mercator map (256px tiles) at the given latitude and zoom
+    return 2 * np.pi * EARTH_RADIUS_METERS * np.cos(np.radians(lat)) / (256 * 2**zoom)
+
+
+def simplify_geometry(geometry, lat, lon, radius_meters, tolerance_meters):
+    """
+    Clip a Polygon or MultiPolygon GeoJSON geometry to the square around (lat, lon) that
+    contains the radius, then simplify it with Douglas-Peucker. Rings are projected to
+    meters around (lat, lon) first, which is accurate enough at the scale of the map.
+    Returns None if nothing is left, other geometry types are returned unchanged.
+    """
+    if geometry["type"] == "Polygon":
+        polygons = [geometry["coordinates"]]
+    elif geometry["type"] == "MultiPolygon":
+        polygons = geometry["coordinates"]
+    else:
+        return geometry
+
+    scale = np.array([np.cos(np.radians(lat)), 1]) * np.pi * EARTH_RADIUS_METERS / 180
+    origin = np.array([lon, lat])
+    simplified = []
+
+    for polygon in polygons:
+        rings = []
+
+        for ring in polygon:
+            points = (np.asarray(ring, dtype=float)[:, :2] - origin) * scale
+            points = clip_ring(points, radius_meters)
+
+            if len(points) >= 4:
+                points = simplify_line(points, tolerance_meters)
+
+            # A ring needs at least 3 distinct points (plus the closing one)
+            if len(points) >= 4:
+                rings.append(np.round(points / scale + origin, 6).tolist())
+            elif not rings:
+                # The outer ring is gone, so is the polygon
+                break
+
+        if rings:
+            simplified.append(rings)
+
+    if not simplified:
+        return None
+
+    if len(simplified) == 1:
+        return {"type": "Polygon", "coordinates": simplified[0]}
+
+    return {"type": "MultiPolygon", "coordinates": simplified}
+
+
+def clip_ring(points, half_size):
+    # Sutherland-Hodgman clipping of a closed ring (n x 2 array) to the square
+    # [-half_size, half_size] on both axes, one edge of the square at a time
+    for axis, sign in [(0, 1), (0, -1), (1, 1), (1, -1)]:
+        if len(points) < 2:
+            break
+
+        inside = sign * points[:, axis] <= half_size
+        start, end = points[:-1], points[1:]
+        start_inside, end_inside = inside[:-1], inside[1:]
+
+        # Edges that don't cross the clip edge get a meaningless crossing, it's not used
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = (sign * half_size - start[:, axis]) / (end[:, axis] - start[:, axis])
+            crossings = start + t[:, np.newaxis] * (end - start)
+
+        # Each edge adds the point where it crosses the clip edge (if it does), then its
+        # end point (if it's inside)
+        candidates = np.stack([crossings, end], axis=1)
+        keep = np.stack([start_inside != end_inside, end_inside], axis=1)
+        points = candidates[keep]
+
+        if len(points):
+            points = np.vstack([points, points[:1]])
+
+    return points
+
+
+def simplify_line(points, tolerance):
+    # Douglas-Peucker simplification of a line (n x 2 array), keeps the first and last
+    # points and every point further than `tolerance` from the simplified line
+    keep = np.zeros(len(points), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(points) - 1)]
+
+    while stack:
+        start, end = stack.pop()
+
+        if end - start < 2:
+            continue
+
+        segment = points[end] - points[start]
+        offsets = points[start + 1 : end] - points[start]
+        length = np.hypot(*segment)
+
+        if length > 0:
+            distances = (
+                np.abs(segment[0] * offsets[:, 1] - segment[1] * offsets[:, 0]) / length
+            )
+        else:
+            # Closed ring, use the distance to the start point
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+
+        index = np.argmax(distances)
+
+        if distances[index] > tolerance:
+            index += start + 1
+            keep[index] = True
+            stack += [(start, index), (index, end)]
+
+    return points[keep]
+
+
+def calc_grid_cells(lat, lon, lats, lons, cell_meters):
+    # Column and row of the square grid cell (cell_meters wide, with a corner at
+    # (lat, lon)) that each of the points in lats/lons is in
+    scale = np.pi * EARTH_RADIUS_METERS / 180
+    x = (np.asarray(lons, dtype=float) - lon) * scale * np.cos(np.radians(lat))
+    y = (np.asarray(lats, dtype=float) - lat) * scale
+
+    return np.floor(x / cell_meters).astype(int), np.floor(y / cell_meters).astype(int)
+
+
+def calc_grid_cell_corners(lat, lon, columns, rows, cell_meters):
+    # (lats, lons) of the bottom left corner of grid cells, see calc_grid_cells
+    scale = np.pi * EARTH_RADIUS_METERS / 180
+
+    return (
+        lat + np.asarray(rows) * cell_meters / scale,
+        lon + np.asarray(columns) * cell_meters / (scale * np.cos(np.radians(lat))),
+    )
@@ -1,49 +1,90 @@
 import streamlit as st
+import numpy as np
+import pandas as pd
 import pydeck as pdk
+from utils.cache import cached
+from utils.geo import (
+    calc_meters_per_pixel,
+    simplify_geometry,
+    calc_grid_cells,
+    calc_grid_cell_corners,
+)
+from utils.settings import get_setting
+from utils.timings import timed
 
 
-def show_map(lat, lon, radius_meters, events):
-    COLOR_RANGE = [
+# Events are coloured by local rank, using the colour of the first break above it
+COLOR_RANGE = np.array(
+    [
         [255, 174, 0],
         [255, 138, 25],
         [255, 104, 49],
         [255, 69, 74],
         [255, 35, 100],
-    ]
+    ],
+    dtype=np.uint8,
+)
 
-    BREAKS = [20, 40, 60, 80, 100]
+BREAKS = [20, 40, 60, 80, 100]
 
-    def color_scale(val):
-        for i, b in enumerate(BREAKS):
-            if val < b:
-                return COLOR_RANGE[i]
-        return COLOR_RANGE[i]
+# The map opens at this zoom level
+MAP_ZOOM = 14
 
-    geojson_features = []
+# Polygons are simplified to about a pixel at MAP_ZOOM, and never to more detail than
+# this many segments across the radius
+SIMPLIFY_RESOLUTION = 1000
 
-    for event in events["results"]:
-        geojson_features.append(
-            {
-                "type": "Feature",
-                "geometry": event["geo"]["geometry"],
-                # NOTE: Not valid GeoJSON, but required for pydeck tooltips (which cannot use properties.* format)
-                "title": event["title"],
-                "id": event["id"],
-                "title": event["title"],
-                "phq_attendance": event["phq_attendance"]
-                if event["phq_attendance"]
-                else "0",
-                "phq_attendance_formatted": "{:,}".format(event["phq_attendance"])
-                if event["phq_attendance"]
-                else "0",
-                "phq_rank": event["rank"],
-                "local_rank": event["local_rank"],
-                "category": event["category"],
-                "fill_color": color_scale(
-                    event["local_rank"] if event["local_rank"] else 0
-                ),
-            }
+# When there are more than AGGREGATE_MIN_EVENTS point events, they're binned into a grid
+# of GRID_CELL_PIXELS wide cells (at MAP_ZOOM) and cells with at least MIN_CELL_EVENTS
+# events are drawn as a single cell instead of one point per event. The thresholds can be
+# changed with `map_aggregate_min_events` and `map_min_cell_events` in the secrets file.
+AGGREGATE_MIN_EVENTS = 500
+MIN_CELL_EVENTS = 5
+GRID_CELL_PIXELS = 32
+
+
+@timed("show_map")
+def show_map(lat, lon, radius_meters, events):
+    """
+    The event layers are built from the event columns (see make_events_frame) rather
+    than one dict per event: point events are sent as a compact table of positions,
+    colours and tooltip fields, and only polygon events are sent as GeoJSON.
+
+    Polygons are clipped to the radius and simplified, so large shapes (e.g. severe
+    weather or school holidays) don't blow up the size of the map. Polygons that end up
+    smaller than the tolerance are shown as points.
+
+    In dense areas, point events are aggregated into grid cells, see aggregate_events.
+    """
+    tolerance_meters = max(
+        calc_meters_per_pixel(lat, MAP_ZOOM), radius_meters / SIMPLIFY_RESOLUTION
+    )
+    geometries = [
+        simplify_event_geometry(
+            event_id, lat, lon, radius_meters, tolerance_meters, _geometry=geometry
         )
+        if geometry is not None
+        else None
+        for event_id, geometry in zip(events["id"], events["geometry"])
+    ]
+    is_point = np.array([geometry is None for geometry in geometries], dtype=bool)
+
+    layer_data = make_layer_data(events)
+    point_events = layer_data[is_point]
+    grid_cells, in_cell = aggregate_events(events[is_point], lat, lon)
+    point_events = point_events[~in_cell]
+    polygon_features = [
+        {
+            "type": "Feature",
+            "geometry": geometry,
+            # NOTE: Not valid GeoJSON, but required for pydeck tooltips (which cannot use properties.* format)
+            **row,
+        }
+        for geometry, row in zip(
+            [geometry for geometry in geometries if geometry is not None],
+            layer_data[~is_point].to_dict(orient="records"),
+        )
+    ]
 
     st.pydeck_chart(
         pdk.Deck(
@@ -59,7 +100,7 @@ def show_map(lat, lon, radius_meters, events):
             initial_view_state=pdk.ViewState(
                 latitude=lat,
                 longitude=lon,
-                zoom=14,
+                zoom=MAP_ZOOM,
             ),
             layers=[
                 # Radius layer
@@ -90,39 +131,167 @@ def show_map(lat, lon, radius_meters, events):
                     get_size=20,
                     pickable=False,
                 ),
+                # Aggregated events layer
+                pdk.Layer(
+                    "GridCellLayer",
+                    data=grid_cells,
+                    get_position="[lon, lat]",
+                    cell_size=calc_grid_cell_meters(lat),
+                    extruded=False,
+                    auto_highlight=True,
+                    pickable=True,
+                    get_fill_color="[r, g, b]",
+                    opacity=0.4,
+                ),
                 # Point-type events layer
                 pdk.Layer(
-                    "GeoJsonLayer",
-                    data=list(
-                        filter(
-                            lambda x: x["geometry"]["type"] == "Point", geojson_features
-                        )
-                    ),
+                    "ScatterplotLayer",
+                    data=point_events,
+                    get_position="[lon, lat]",
                     auto_highlight=True,
                     pickable=True,
                     filled=True,
-                    get_fill_color="fill_color",
+                    get_fill_color="[r, g, b]",
                     stroked=False,
                     opacity=0.8,
-                    get_point_radius=20,
+                    get_radius=20,
                 ),
                 # Polygon-type events layer
                 pdk.Layer(
                     "GeoJsonLayer",
-                    data=list(
-                        filter(
-                            lambda x: x["geometry"]["type"] != "Point", geojson_features
-                        )
-                    ),
+                    data=polygon_features,
                     auto_highlight=True,
                     pickable=True,
                     filled=True,
                     stroked=True,
-                    get_line_color="fill_color",
-                    get_fill_color="fill_color",
+                    get_line_color="[r, g, b]",
+                    get_fill_color="[r, g, b]",
                     opacity=0.1,
                     get_line_width=10,
                 ),
             ],
         )
     )
+
+
+@timed("make_layer_data")
+def make_layer_data(events):
+    # One row per event with just the fields used by the layers and the tooltip
+    local_rank = events["local_rank"].fillna(0).to_numpy(dtype=float)
+    colors = COLOR_RANGE[
+        np.minimum(np.digitize(local_rank, BREAKS), len(COLOR_RANGE) - 1)
+    ]
+
+    return pd.DataFrame(
+        {
+            # ~10cm precision is plenty and keeps the JSON sent to the browser small
+            "lat": events["lat"].round(6),
+            "lon": events["lon"].round(6),
+            "r": colors[:, 0],
+            "g": colors[:, 1],
+            "b": colors[:, 2],
+            "title": events["title"],
+            "phq_attendance_formatted": events["phq_attendance"].map("{:,}".format),
+            "phq_rank": events["rank"],
+            "local_rank": events["local_rank"]
+            .astype(object)
+            .where(events["local_rank"].notna(), None),
+            "category": events["category"].astype(object),
+        }
+    )
+
+
+@timed("aggregate_events")
+def aggregate_events(events, lat, lon):
+    """
+    Bin events into grid cells around the location. Returns a frame with one row per
+    cell with at least `map_min_cell_events` events (its bottom left corner, colour and
+    tooltip fields, with the Predicted Attendance summed over the cell) and a mask of the
+    events in those cells. Nothing is aggregated for fewer than
+    `map_aggregate_min_events` events.
+    """
+    min_cell_events = int(get_setting("map_min_cell_events", MIN_CELL_EVENTS))
+    in_cell = np.full(len(events), False)
+
+    if len(events) <= int(
+        get_setting("map_aggregate_min_events", AGGREGATE_MIN_EVENTS)
+    ):
+        return pd.DataFrame(), in_cell
+
+    cell_meters = calc_grid_cell_meters(lat)
+    columns, rows = calc_grid_cells(lat, lon, events["lat"], events["lon"], cell_meters)
+    binned = pd.DataFrame(
+        {
+            "column": columns,
+            "row": rows,
+            "phq_attendance": events["phq_attendance"].to_numpy(),
+            "rank": events["rank"].to_numpy(),
+            "local_rank": events["local_rank"].to_numpy(dtype=float, na_value=np.nan),
+            "category": events["category"].to_numpy(),
+        }
+    )
+    in_cell = (
+        binned.groupby(["column", "row"])["column"].transform("size").to_numpy()
+        >= min_cell_events
+    )
+    binned = binned[in_cell]
+
+    if not len(binned):
+        return pd.DataFrame(), in_cell
+
+    cells = binned.groupby(["column", "row"]).agg(
+        count=("rank", "size"),
+        phq_attendance=("phq_attendance", "sum"),
+        phq_rank=("rank", "max"),
+        local_rank=("local_rank", "max"),
+    )
+    # The most common category in each cell
+    categories = (
+        binned.groupby(["column", "row", "category"], observed=True)
+        .size()
+        .sort_values(ascending=False)
+        .reset_index()
+        .drop_duplicates(["column", "row"])
+        .set_index(["column", "row"])["category"]
+    )
+    cells = cells.join(categories).reset_index()
+
+    # Cells are coloured by their share of the busiest cell's attendance
+    share = cells["phq_attendance"] / max(cells["phq_attendance"].max(), 1) * 100
+    colors = COLOR_RANGE[np.minimum(np.digitize(share, BREAKS), len(COLOR_RANGE) - 1)]
+    cell_lats, cell_lons = calc_grid_cell_corners(
+        lat, lon, cells["column"], cells["row"], cell_meters
+    )
+
+    return (
+        pd.DataFrame(
+            {
+                "lat": np.round(cell_lats, 6),
+                "lon": np.round(cell_lons, 6),
+                "r": colors[:, 0],
+                "g": colors[:, 1],
+                "b": colors[:, 2],
+                "title": cells["count"].map("{:,} events".format),
+                "phq_attendance_formatted": cells["phq_attendance"].map("{:,}".format),
+                "phq_rank": cells["phq_rank"],
+                "local_rank": cells["local_rank"]
+                .astype("Int64")
+                .astype(object)
+                .where(cells["local_rank"].notna(), None),
+                "category": cells["category"].astype(object),
+            }
+        ),
+        in_cell,
+    )
+
+
+def calc_grid_cell_meters(lat):
+    return calc_meters_per_pixel(lat, MAP_ZOOM) * GRID_CELL_PIXELS
+
+
+@cached("event_geometry")
+def simplify_event_geometry(
+    event_id, lat, lon, radius_meters, tolerance_meters, _geometry
+):
+    # Cached per event, the geometry itself isn't part of the cache key
+    return simplify_geometry(_geometry, lat, lon, radius_meters, tolerance_meters)
@@ -1,19 +1,24 @@
 import streamlit as st
 import datetime
+import time
 import pandas as pd
+from functools import partial
 from utils.predicthq import (
-    fetch_features,
-    fetch_demand_surges,
+    fetch_windowed_demand_surges,
     fetch_event_counts,
-    calc_sum_of_features,
     calc_sum_of_event_counts,
     ATTENDED_CATEGORIES,
     NON_ATTENDED_CATEGORIES,
     PHQ_ATTENDANCE_FEATURES,
 )
 from utils.map import show_map
+from utils.features import fetch_features_matrix, calc_period_totals
+from utils.parallel import run_in_parallel
+from utils.cache import track_served_entries
+from utils.timings import timed
 
 
+@timed("show_metrics")
 def show_metrics():
     location = st.session_state.location if "location" in st.session_state else None
     daterange = st.session_state.daterange if "daterange" in st.session_state else None
@@ -30,158 +35,218 @@ def show_metrics():
         and suggested_radius is not None
         and radius is not None
     ):
+        show_location_metrics(
+            location,
+            suggested_radius,
+            radius,
+            date_from=daterange["date_from"],
+            date_to=daterange["date_to"],
+        )
 
-        # Pull out date range to make them easier to work with
-        date_from = daterange["date_from"]
-        date_to = daterange["date_to"]
 
-        # Work out previous date range for delta comparisons
-        previous_date_from = date_from - (date_to - date_from)
-        previous_date_to = date_from
+def show_location_metrics(location, suggested_radius, radius, date_from, date_to):
+    # Keep track of how old the (cached) data behind the metrics is
+    with track_served_entries() as served:
+        metrics = calc_metrics(location, radius, date_from, date_to)
 
-        # Fetch sum of Predicted Attendance
-        phq_attendance_features = fetch_features(
-            location["lat"],
-            location["lon"],
-            radius,
-            date_from=date_from,
-            date_to=date_to,
-            features=PHQ_ATTENDANCE_FEATURES,
-        )
-        phq_attendance_sum = calc_sum_of_features(
-            phq_attendance_features, PHQ_ATTENDANCE_FEATURES
+    # Display metrics
+    col1, col2, col3, col4, col5, col6 = st.columns(6)
+
+    with col1:
+        st.metric(
+            label="Suggested Radius",
+            value=f"{suggested_radius['radius']}{suggested_radius['radius_unit']}",
+            help="[Suggested Radius Docs](https://docs.predicthq.com/resources/suggested-radius)",
         )
 
-        # Fetch previous predicted attendance
-        previous_phq_attendance_features = fetch_features(
-            location["lat"],
-            location["lon"],
-            radius,
-            date_from=previous_date_from,
-            date_to=previous_date_to,
-            features=PHQ_ATTENDANCE_FEATURES,
+    with col2:
+        delta_pct = calc_delta_pct(
+            metrics["phq_attendance_sum"], metrics["previous_phq_attendance_sum"]
         )
-        previous_phq_attendance_sum = calc_sum_of_features(
-            previous_phq_attendance_features, PHQ_ATTENDANCE_FEATURES
+        st.metric(
+            label="Predicted Attendance",
+            value=f"{metrics['phq_attendance_sum']:,.0f}",
+            delta=f"{delta_pct:,.0f}%",
+            help=f"The predicted number of people attending events in the selected date range. Previous period: {metrics['previous_phq_attendance_sum']:,.0f}.",
         )
 
-        # Work out average daily predicted attendance
-        days = (date_to - date_from).days
-        average_daily_attendance = phq_attendance_sum / days
-        previous_average_daily_attendance = previous_phq_attendance_sum / days
-
-        # Fetch event counts/stats
-        counts = fetch_event_counts(
-            location["lat"],
-            location["lon"],
-            radius,
-            date_from=date_from,
-            date_to=date_to,
-            tz=location["tz"],
+    with col3:
+        delta_pct = calc_delta_pct(
+            metrics["average_daily_attendance"],
+            metrics["previous_average_daily_attendance"],
         )
-        attended_events_sum = calc_sum_of_event_counts(counts, ATTENDED_CATEGORIES)
-        non_attended_events_sum = calc_sum_of_event_counts(
-            counts, NON_ATTENDED_CATEGORIES
+        st.metric(
+            label="Avg Daily Attendance",
+            value=f"{metrics['average_daily_attendance']:,.0f}",
+            delta=f"{delta_pct:,.0f}%",
+            help=f"The average daily predicted number of people attending events in the selected date range. Previous period: {metrics['previous_average_daily_attendance']:,.0f}.",
         )
 
-        # Fetch event counts/stats for previous period
-        previous_counts = fetch_event_counts(
-            location["lat"],
-            location["lon"],
-            radius,
-            date_from=previous_date_from,
-            date_to=previous_date_to,
-            tz=location["tz"],
+    with col4:
+        delta_pct = calc_delta_pct(
+            metrics["attended_events_sum"], metrics["previous_attended_events_sum"]
         )
-        previous_attended_events_sum = calc_sum_of_event_counts(
-            previous_counts, ATTENDED_CATEGORIES
-        )
-        previous_non_attended_events_sum = calc_sum_of_event_counts(
-            previous_counts, NON_ATTENDED_CATEGORIES
+        st.metric(
+            label="Attended Events",
+            value=metrics["attended_events_sum"],
+            delta=f"{delta_pct:,.0f}%",
+            help=f"Total number of attended events in the selected date range. Previous period: {metrics['previous_attended_events_sum']}.",
         )
 
-        # Fetch Demand Surges
-        demand_surges = fetch_demand_surges(
-            location["lat"],
-            location["lon"],
-            radius,
-            date_from=date_from,
-            date_to=date_to,
+    with col5:
+        delta_pct = calc_delta_pct(
+            metrics["non_attended_events_sum"],
+            metrics["previous_non_attended_events_sum"],
+        )
+        st.metric(
+            label="Non-Attended Events",
+            value=metrics["non_attended_events_sum"],
+            delta=f"{delta_pct:,.0f}%",
+            help=f"Total number of non-attended events in the selected date range. Previous period: {metrics['previous_non_attended_events_sum']}.",
         )
-        demand_surges_count = len(demand_surges)
 
-        previous_demand_surges = fetch_demand_surges(
-            location["lat"],
-            location["lon"],
-            radius,
-            date_from=previous_date_from,
-            date_to=previous_date_to,
+    with col6:
+        delta_pct = calc_delta_pct(
+            metrics["demand_surges_count"], metrics["previous_demand_surges_count"]
         )
-        previous_demand_surges_count = len(previous_demand_surges)
-
-        # Display metrics
-        col1, col2, col3, col4, col5, col6 = st.columns(6)
-
-        with col1:
-            st.metric(
-                label="Suggested Radius",
-                value=f"{suggested_radius['radius']}{suggested_radius['radius_unit']}",
-                help="[Suggested Radius Docs](https://docs.predicthq.com/resources/suggested-radius)",
-            )
-
-        with col2:
-            delta_pct = calc_delta_pct(phq_attendance_sum, previous_phq_attendance_sum)
-            st.metric(
-                label="Predicted Attendance",
-                value=f"{phq_attendance_sum:,.0f}",
-                delta=f"{delta_pct:,.0f}%",
-                help=f"The predicted number of people attending events in the selected date range. Previous period: {previous_phq_attendance_sum:,.0f}.",
-            )
-
-        with col3:
-            delta_pct = calc_delta_pct(
-                average_daily_attendance, previous_average_daily_attendance
-            )
-            st.metric(
-                label="Avg Daily Attendance",
-                value=f"{average_daily_attendance:,.0f}",
-                delta=f"{delta_pct:,.0f}%",
-                help=f"The average daily predicted number of people attending events in the selected date range. Previous period: {previous_average_daily_attendance:,.0f}.",
-            )
-
-        with col4:
-            delta_pct = calc_delta_pct(
-                attended_events_sum, previous_attended_events_sum
-            )
-            st.metric(
-                label="Attended Events",
-                value=attended_events_sum,
-                delta=f"{delta_pct:,.0f}%",
-                help=f"Total number of attended events in the selected date range. Previous period: {previous_attended_events_sum}.",
-            )
-
-        with col5:
-            delta_pct = calc_delta_pct(
-                non_attended_events_sum, previous_non_attended_events_sum
-            )
-            st.metric(
-                label="Non-Attended Events",
-                value=non_attended_events_sum,
-                delta=f"{delta_pct:,.0f}%",
-                help=f"Total number of non-attended events in the selected date range. Previous period: {previous_non_attended_events_sum}.",
-            )
-
-        with col6:
-            delta_pct = calc_delta_pct(
-                demand_surges_count, previous_demand_surges_count
-            )
-            st.metric(
-                label="Demand Surges",
-                value=demand_surges_count,
-                delta=f"{delta_pct:,.0f}%",
-                help=f"Number of [Demand Surges](https://docs.predicthq.com/resources/demand-surge) in the selected date range. Previous period: {previous_demand_surges_count}.",
-            )
+        st.metric(
+            label="Demand Surges",
+            value=metrics["demand_surges_count"],
+            delta=f"{delta_pct:,.0f}%",
+            help=f"Number of [Demand Surges](https://docs.predicthq.com/resources/demand-surge) in the selected date range. Previous period: {metrics['previous_demand_surges_count']}.",
+        )
+
+    show_data_age(served)
+
+
+@timed("calc_metrics")
+def calc_metrics(location, radius, date_from, date_to):
+    """
+    Fetch everything needed for the metrics of a location and date range, and work out the
+    values for the current and previous periods. This is also used to pre-warm the cache,
+    so the API calls made here must match the ones made when the page is shown.
+    """
+    # Work out previous date range for delta comparisons
+    previous_date_from, previous_date_to = calc_previous_date_range(date_from, date_to)
+
+    # The API calls below are independent of each other, so run them concurrently
+    results = run_in_parallel(
+        {
+            # Fetch Predicted Attendance for both periods with a single request
+            "phq_attendance_matrix": partial(
+                fetch_features_matrix,
+                location["lat"],
+                location["lon"],
+                radius,
+                date_from=previous_date_from,
+                date_to=date_to,
+                features=PHQ_ATTENDANCE_FEATURES,
+            ),
+            # Fetch event counts/stats
+            "counts": partial(
+                fetch_event_counts,
+                location["lat"],
+                location["lon"],
+                radius,
+                date_from=date_from,
+                date_to=date_to,
+                tz=location["tz"],
+            ),
+            # Fetch event counts/stats for previous period
+            "previous_counts": partial(
+                fetch_event_counts,
+                location["lat"],
+                location["lon"],
+                radius,
+                date_from=previous_date_from,
+                date_to=previous_date_to,
+                tz=location["tz"],
+            ),
+            # Fetch Demand Surges for both periods
+            "demand_surges": partial(
+                fetch_windowed_demand_surges,
+                location["lat"],
+                location["lon"],
+                radius,
+                date_from=date_from,
+                date_to=date_to,
+                previous_date_from=previous_date_from,
+                previous_date_to=previous_date_to,
+            ),
+        }
+    )
+
+    # Both periods are summed from the same date x feature matrix
+    phq_attendance_matrix = results["phq_attendance_matrix"]
+    phq_attendance_sum, previous_phq_attendance_sum = calc_period_totals(
+        phq_attendance_matrix,
+        date_from,
+        date_to,
+        previous_date_from,
+        previous_date_to,
+    )
+
+    # Work out average daily predicted attendance
+    days = (date_to - date_from).days
+    average_daily_attendance = phq_attendance_sum / days
+    previous_average_daily_attendance = previous_phq_attendance_sum / days
+
+    counts = results["counts"]
+    attended_events_sum = calc_sum_of_event_counts(counts, ATTENDED_CATEGORIES)
+    non_attended_events_sum = calc_sum_of_event_counts(counts, NON_ATTENDED_CATEGORIES)
+
+    previous_counts = results["previous_counts"]
+    previous_attended_events_sum = calc_sum_of_event_counts(
+        previous_counts, ATTENDED_CATEGORIES
+    )
+    previous_non_attended_events_sum = calc_sum_of_event_counts(
+        previous_counts, NON_ATTENDED_CATEGORIES
+    )
+
+    demand_surges, previous_demand_surges = results["demand_surges"]
+    demand_surges_count = len(demand_surges)
+    previous_demand_surges_count = len(previous_demand_surges)
+
+    return {
+        "phq_attendance_sum": phq_attendance_sum,
+        "previous_phq_attendance_sum": previous_phq_attendance_sum,
+        "average_daily_attendance": average_daily_attendance,
+        "previous_average_daily_attendance": previous_average_daily_attendance,
+        "attended_events_sum": attended_events_sum,
+        "previous_attended_events_sum": previous_attended_events_sum,
+        "non_attended_events_sum": non_attended_events_sum,
+        "previous_non_attended_events_sum": previous_non_attended_events_sum,
+        "demand_surges_count": demand_surges_count,
+        "previous_demand_surges_count": previous_demand_surges_count,
+    }
 
 
 def calc_delta_pct(current, previous):
     return ((current - previous) / previous * 100) if previous > 0 else 0
+
+
+def calc_previous_date_range(date_from, date_to):
+    # The previous period has the same length and ends where the current one starts
+    return date_from - (date_to - date_from), date_from
+
+
+def show_data_age(served):
+    # Show how old the cached data behind the metrics is, and whether it's being refreshed
+    if not served:
+        return
+
+    age = time.time() - min(entry["created"] for entry in served)
+    caption = f"Data updated {format_age(age)} ago"
+
+    if any(entry["stale"] for entry in served):
+        caption += " (refreshing in the background)"
+
+    st.caption(caption)
+
+
+def format_age(seconds):
+    if seconds < 60:
+        return "less than a minute"
+    if seconds < 60 * 60:
+        return f"{seconds // 60:.0f} min"
+    return f"{seconds // (60 * 60):.0f} hr"
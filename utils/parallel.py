@@ -0,0 +1,64 @@
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+
+def run_in_parallel(tasks, max_workers=None):
+    """
+    Run independent calls concurrently and wait for all of them to finish.
+
+    `tasks` maps a name to a zero-argument callable (e.g. a `functools.partial`) and the
+    results are returned as a dict with the same names. If a call raises, the exception is
+    re-raised here, in the same order the tasks were given, so errors surface just like
+    they would if the calls were made one after another.
+    """
+    if not tasks:
+        return {}
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(tasks)) as executor:
+        futures = {
+            name: executor.submit(with_caller_context(task))
+            for name, task in tasks.items()
+        }
+
+    return {name: future.result() for name, future in futures.items()}
+
+
+def iter_in_parallel(tasks, max_workers=None):
+    """
+    Like run_in_parallel but takes a list of callables and returns an iterator over their
+    results, in order, as soon as each is available, so the caller can use the first
+    results while the rest are still running. The tasks are started straight away, not
+    when the first result is asked for.
+    """
+    if not tasks:
+        return iter([])
+
+    executor = ThreadPoolExecutor(max_workers=max_workers or len(tasks))
+    futures = [executor.submit(with_caller_context(task)) for task in tasks]
+
+    return iter_results(executor, futures)
+
+
+def iter_results(executor, futures):
+    try:
+        for future in futures:
+            yield future.result()
+    finally:
+        # Don't start tasks nobody is waiting for any more (e.g. on errors)
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def with_caller_context(task):
+    # Cached functions need the Streamlit script context of the calling session, which
+    # is stored per thread, so pass it on to the worker thread running the task. The
+    # context variables (e.g. utils.cache.track_served_entries) are passed on too.
+    ctx = get_script_run_ctx()
+    context = contextvars.copy_context()
+
+    def run():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return context.run(task)
+
+    return run
@@ -0,0 +1,227 @@
+import logging
+from collections import defaultdict
+from functools import partial
+import numpy as np
+from utils.geo import calc_haversine_distances, calc_grid_cells
+from utils.parallel import run_in_parallel
+from utils.predicthq import (
+    iter_events_pages,
+    search_events_page,
+    combine_events_pages,
+    MAX_EVENTS,
+)
+from utils.settings import get_setting
+
+# Largest radius of the region searched for a group of locations, in km (can be changed
+# with `region_max_radius` in the secrets file). Bigger regions mean fewer API calls but
+# more events downloaded that aren't near any of the locations.
+REGION_MAX_RADIUS = 5.0
+
+# Number of regions fetched at a time
+REGION_WORKERS = 4
+
+logger = logging.getLogger(__name__)
+
+
+def plan_regions(locations, max_radius_meters):
+    """
+    Group locations whose radius fits in a region (a circle around one of them) of at
+    most `max_radius_meters`, so the events for the whole group can be fetched with one
+    search. Each location is a dict with `lat`, `lon`, `radius_meters`, and the `tz`,
+    `date_from` and `date_to` of the search, which must be the same within a region.
+
+    Locations are put in grid buckets the size of a region first, so only locations in
+    neighbouring buckets are compared. Returns a list of regions, each a dict with `lat`,
+    `lon`, `radius_meters`, `tz`, `date_from`, `date_to` and `members` (the indexes of its
+    locations).
+    """
+    if not locations:
+        return []
+
+    lats = np.array([location["lat"] for location in locations], dtype=float)
+    lons = np.array([location["lon"] for location in locations], dtype=float)
+    radii = np.array([location["radius_meters"] for location in locations], dtype=float)
+    searches = [
+        (location["tz"], location["date_from"], location["date_to"])
+        for location in locations
+    ]
+
+    # Buckets are relative to the first location, which is plenty accurate at this scale
+    columns, rows = calc_grid_cells(lats[0], lons[0], lats, lons, max_radius_meters)
+    buckets = defaultdict(list)
+
+    for index, cell in enumerate(zip(columns, rows)):
+        buckets[cell].append(index)
+
+    assigned = np.full(len(locations), False)
+    regions = []
+
+    # Start with the locations with the largest radius, they're the best region centres
+    for seed in np.argsort(-radii, kind="stable"):
+        if assigned[seed]:
+            continue
+
+        candidates = np.array(
+            [
+                index
+                for column in range(columns[seed] - 1, columns[seed] + 2)
+                for row in range(rows[seed] - 1, rows[seed] + 2)
+                for index in buckets.get((column, row), [])
+                if not assigned[index] and searches[index] == searches[seed]
+            ]
+        )
+        # How far the region has to reach to cover each candidate's radius
+        reach = (
+            calc_haversine_distances(
+                lats[seed], lons[seed], lats[candidates], lons[candidates]
+            )
+            + radii[candidates]
+        )
+        in_region = reach <= max(max_radius_meters, radii[seed])
+        assigned[candidates[in_region]] = True
+        tz, date_from, date_to = searches[seed]
+
+        regions.append(
+            {
+                "lat": lats[seed],
+                "lon": lons[seed],
+                "radius_meters": float(reach[in_region].max()),
+                "tz": tz,
+                "date_from": date_from,
+                "date_to": date_to,
+                "members": sorted(candidates[in_region].tolist()),
+            }
+        )
+
+    return regions
+
+
+def fetch_events_for_locations(locations, max_workers=None):
+    """
+    Fetch the events within the radius of each location (see plan_regions for the
+    fields) with one search per region and assign them to the locations locally. Returns
+    a list with an events frame (see make_events_frame) per location.
+    """
+    max_radius_meters = (
+        float(get_setting("region_max_radius", REGION_MAX_RADIUS)) * 1000
+    )
+    max_workers = max_workers or int(get_setting("region_workers", REGION_WORKERS))
+    regions = plan_regions(locations, max_radius_meters)
+
+    logger.info(
+        "Fetching events for %d locations with %d searches",
+        len(locations),
+        len(regions),
+    )
+
+    region_events = fetch_regions_events(regions, max_workers)
+
+    # A region search only returns the `max_events` busiest events of the whole region,
+    # which aren't always the busiest ones within each member's radius. Search for each
+    # member of those regions instead, so they get the same events as on their own.
+    truncated = [index for index, events in enumerate(region_events) if events is None]
+
+    if truncated:
+        member_regions = [
+            make_location_region(locations[member], member)
+            for index in truncated
+            for member in regions[index]["members"]
+        ]
+        logger.info(
+            "%d regions have more than `max_events` events, fetching events for their "
+            "%d locations one by one",
+            len(truncated),
+            len(member_regions),
+        )
+        regions += member_regions
+        region_events += fetch_regions_events(member_regions, max_workers)
+
+    events = [None] * len(locations)
+
+    for region, events_in_region in zip(regions, region_events):
+        if events_in_region is None:
+            continue
+
+        lats = events_in_region["lat"].to_numpy()
+        lons = events_in_region["lon"].to_numpy()
+
+        for member in region["members"]:
+            location = locations[member]
+            distances = calc_haversine_distances(
+                location["lat"], location["lon"], lats, lons
+            )
+            events[member] = events_in_region[
+                distances <= location["radius_meters"]
+            ].reset_index(drop=True)
+
+    return events
+
+
+def fetch_regions_events(regions, max_workers):
+    results = run_in_parallel(
+        {
+            index: partial(fetch_region_events, region)
+            for index, region in enumerate(regions)
+        },
+        max_workers=max_workers,
+    )
+
+    return [results[index] for index in range(len(regions))]
+
+
+def make_location_region(location, index):
+    # A region searching exactly the location's radius
+    return {
+        "lat": location["lat"],
+        "lon": location["lon"],
+        "radius_meters": location["radius_meters"],
+        "tz": location["tz"],
+        "date_from": location["date_from"],
+        "date_to": location["date_to"],
+        "members": [index],
+    }
+
+
+def fetch_region_events(region):
+    """
+    Fetch the events of a region, or None when the region has several members and more
+    than `max_events` events, see fetch_events_for_locations.
+    """
+    if len(region["members"]) > 1:
+        # Round the radius up to the next 10m so similar regions share cached pages
+        radius = np.ceil(region["radius_meters"] / 10) / 100
+    else:
+        radius = region["radius_meters"] / 1000
+
+    search = (
+        region["lat"],
+        region["lon"],
+        radius,
+        region["date_from"],
+        region["date_to"],
+        region["tz"],
+        "km",
+    )
+
+    # The first page tells how many events there are (and it's cached for the search)
+    if len(region["members"]) > 1:
+        count = search_events_page(*search)["count"]
+
+        if count > int(get_setting("max_events", MAX_EVENTS)):
+            return None
+
+    pages = []
+
+    for page, _, total in iter_events_pages(*search):
+        pages.append(page)
+
+    if pages[0]["count"] > total:
+        logger.warning(
+            "Only %d of the %d events around %s,%s were fetched, raise `max_events`",
+            total,
+            pages[0]["count"],
+            region["lat"],
+            region["lon"],
+        )
+
+    return combine_events_pages(pages)
@@ -1,7 +1,32 @@
+import asyncio
+import contextlib
+import contextvars
 import datetime
+import random
+import threading
+import time
+from functools import partial
+from urllib.parse import urlparse
+import numpy as np
+import pandas as pd
 import requests
-import streamlit as st
 from predicthq import Client
+from predicthq.exceptions import ClientError, ServerError
+from requests.adapters import HTTPAdapter
+from utils.settings import get_setting
+from utils.geo import calc_haversine_distances, calc_meters
+from utils.timings import timed
+from utils.parallel import iter_in_parallel, run_in_parallel
+from utils.cache import (
+    cached,
+    run_single_flight,
+    refresh_in_background,
+    get_cached_feature_days,
+    peek_cached_feature_days,
+    set_cached_feature_days,
+    get_cached_demand_surge_windows,
+    add_cached_demand_surge_window,
+)
 
 
 ATTENDED_CATEGORIES = [
@@ -28,6 +53,52 @@ UNSCHEDULED_CATEGORIES = [
     "severe-weather",
     "terror",
 ]
+ALL_CATEGORIES = ATTENDED_CATEGORIES + NON_ATTENDED_CATEGORIES + UNSCHEDULED_CATEGORIES
+
+# Default number of keep-alive connections in the shared HTTP connection pool
+HTTP_POOL_SIZE = 20
+
+# Process-wide singletons, also used outside of `streamlit run` (where st.cache_resource
+# doesn't cache anything)
+_clients = {}
+_http_session = None
+_clients_lock = threading.Lock()
+
+# Every API request is throttled with a token bucket per endpoint: up to `burst` requests
+# at once, then `rate` requests per second. Override per endpoint (features, events,
+# events_count, demand-surge, suggested-radius) in the secrets file, e.g.
+#
+#   [rate_limits.features]
+#   rate = 5
+#   burst = 10
+RATE_LIMIT = {"rate": 10, "burst": 20}
+
+# Requests failing with a 429, a 5xx or a connection error are retried this many times,
+# waiting a random time up to RETRY_BACKOFF * 2^attempt seconds (or the Retry-After
+# header, up to REQUEST_TIMEOUT seconds) in between. Each attempt times out after REQUEST_TIMEOUT seconds. All three
+# can be changed with `max_retries`, `retry_backoff` and `request_timeout`.
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.5
+REQUEST_TIMEOUT = 30
+
+# Request priorities, interactive requests are always sent before background ones
+INTERACTIVE = 0
+BACKGROUND = 1
+
+_rate_limiters = {}
+_request_priority = contextvars.ContextVar("request_priority", default=INTERACTIVE)
+
+# The radius slider in the sidebar goes up to this value
+MAX_RADIUS = 10.0
+
+# Events are fetched in pages of this size, several pages at a time, up to MAX_EVENTS
+# (both can be changed with `events_page_workers` and `max_events` in the secrets file)
+EVENTS_PAGE_SIZE = 200
+EVENTS_PAGE_WORKERS = 4
+MAX_EVENTS = 2000
+
+# The Demand Surge API always returns surges for a 90d window
+DEMAND_SURGE_WINDOW = datetime.timedelta(days=90)
 
 # Some of the possible phq_attendance features are commented out below to match what
 # we do in our Location Insights product. You can uncomment them to include them in.
@@ -46,22 +117,344 @@ PHQ_ATTENDANCE_FEATURES = [
 
 
 def get_api_key():
-    return st.secrets["api_key"]
+    return get_setting("api_key")
 
 
 def get_predicthq_client():
+    # One client per API key for the whole process (shared by all sessions)
     api_key = get_api_key()
-    phq = Client(access_token=api_key)
 
-    return phq
+    with _clients_lock:
+        if api_key not in _clients:
+            _clients[api_key] = PooledClient(access_token=api_key)
+
+        return _clients[api_key]
+
+
+def get_http_session():
+    """
+    A single requests session shared by every PredictHQ call in the process, so
+    connections are kept alive and reused instead of paying for a new TCP/TLS handshake
+    on every call. The pool size can be set with `http_pool_size` in the secrets file.
+    """
+    global _http_session
+
+    with _clients_lock:
+        if _http_session is None:
+            pool_size = int(get_setting("http_pool_size", HTTP_POOL_SIZE))
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+
+            _http_session = requests.Session()
+            _http_session.mount("https://", adapter)
+            _http_session.mount("http://", adapter)
+
+        return _http_session
+
+
+class PooledClient(Client):
+    """
+    The SDK client sends every request with `requests.request`, which opens a new
+    connection each time. This sends them through the shared session instead.
+    """
+
+    def request(self, method, path, **kwargs):
+        headers = self.get_headers(kwargs.pop("headers", {}))
+        response = send_request(method, self.build_url(path), headers=headers, **kwargs)
+
+        try:
+            response.raise_for_status()
+        except requests.HTTPError:
+            try:
+                error = response.json()
+            except ValueError:
+                error = response.content
+
+            if 400 <= response.status_code <= 499:
+                raise ClientError(error)
+            else:
+                raise ServerError(error)
 
+        try:
+            return response.json() or None
+        except ValueError:
+            return None
+
+
+def send_request(method, url, **kwargs):
+    """
+    Every PredictHQ API call goes through here: it waits for the endpoint's rate limiter
+    (see RATE_LIMIT), sends the request through the shared session and retries it, with
+    jitter, if it's rate limited or fails on the server side.
+    """
+    rate_limiter = get_rate_limiter(get_endpoint_name(url))
+    max_retries = int(get_setting("max_retries", MAX_RETRIES))
+    kwargs.setdefault("timeout", get_setting("request_timeout", REQUEST_TIMEOUT))
+
+    for attempt in range(max_retries + 1):
+        rate_limiter.acquire(get_request_priority())
+
+        try:
+            response = get_http_session().request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == max_retries:
+                raise
+
+            time.sleep(get_retry_delay(None, attempt))
+            continue
+
+        if (
+            response.status_code != 429 and response.status_code < 500
+        ) or attempt == max_retries:
+            return response
+
+        time.sleep(get_retry_delay(response, attempt))
+
+
+def get_retry_delay(response, attempt):
+    # Use the Retry-After header when we're told how long to wait, but don't keep a
+    # page waiting for longer than a request could take
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+
+    if retry_after is not None and retry_after.isdigit():
+        max_delay = float(get_setting("request_timeout", REQUEST_TIMEOUT))
+        return min(int(retry_after) + random.uniform(0, 1), max_delay)
+
+    # Otherwise exponential backoff with full jitter, so retries from many sessions
+    # don't all hit the API at the same moment
+    backoff = float(get_setting("retry_backoff", RETRY_BACKOFF))
+    return random.uniform(0, backoff * 2**attempt)
+
+
+def get_endpoint_name(url):
+    # e.g. https://api.predicthq.com/v1/events/count/ -> events_count
+    return "_".join(part for part in urlparse(url).path.split("/")[2:] if part)
+
+
+def get_rate_limiter(endpoint):
+    with _clients_lock:
+        if endpoint not in _rate_limiters:
+            rate_limit = dict(RATE_LIMIT)
+            rate_limit.update(get_setting("rate_limits", {}).get(endpoint, {}))
+            _rate_limiters[endpoint] = TokenBucket(
+                rate_limit["rate"], rate_limit["burst"]
+            )
+
+        return _rate_limiters[endpoint]
+
+
+def get_request_priority():
+    return _request_priority.get()
+
+
+@contextlib.contextmanager
+def background_requests():
+    """
+    Mark the API requests made inside the block (including calls made by
+    run_in_parallel) as background requests, e.g. for pre-warming the cache. They only
+    get a token when no interactive request is waiting for one.
+    """
+    token = _request_priority.set(BACKGROUND)
 
-@st.cache_data
+    try:
+        yield
+    finally:
+        _request_priority.reset(token)
+
+
+class TokenBucket:
+    """
+    Holds up to `burst` tokens and adds `rate` tokens per second. Each request takes a
+    token, waiting for one if needed. Waiting requests are served by priority: a
+    request only gets a token when no request with a higher priority is waiting.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.waiting = [0, 0]
+        self.condition = threading.Condition()
+
+    def acquire(self, priority=INTERACTIVE):
+        with self.condition:
+            self.waiting[priority] += 1
+
+            try:
+                while True:
+                    self.refill()
+
+                    if self.tokens >= 1 and not any(self.waiting[:priority]):
+                        self.tokens -= 1
+                        return
+
+                    # Wake up when the next token is due (or when woken by a release)
+                    self.condition.wait(max((1 - self.tokens) / self.rate, 0.01))
+            finally:
+                self.waiting[priority] -= 1
+                self.condition.notify_all()
+
+    async def acquire_async(self, priority=INTERACTIVE):
+        # Same as acquire for coroutines: the wait is worked out under the lock, then
+        # slept on the event loop so no thread is blocked while waiting for a token
+        with self.condition:
+            self.waiting[priority] += 1
+
+        try:
+            while True:
+                with self.condition:
+                    self.refill()
+
+                    if self.tokens >= 1 and not any(self.waiting[:priority]):
+                        self.tokens -= 1
+                        return
+
+                    delay = max((1 - self.tokens) / self.rate, 0.01)
+
+                await asyncio.sleep(delay)
+        finally:
+            with self.condition:
+                self.waiting[priority] -= 1
+                self.condition.notify_all()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.burst)
+        self.updated = now
+
+
+@timed("fetch_features")
 def fetch_features(lat, lon, radius, date_from, date_to, features=[], radius_unit="mi"):
     """
     Features API only works with local time, so any date range used is based on the timezone
     at the location being queried.
+
+    Rows are cached per (location, radius, feature, date) rather than per date range, so
+    only the days we haven't seen yet are requested from the API and the result is put
+    together from the cached rows. Expired rows are served while they're refreshed in the
+    background, as long as they're within the cache policy's max_staleness.
     """
+    location_key = (lat, lon, radius, radius_unit)
+    dates = get_dates_in_range(date_from, date_to)
+    rows, missing_dates, stale_dates = get_cached_feature_rows(
+        location_key, features, dates
+    )
+
+    for missing_from, missing_to in group_consecutive_dates(missing_dates):
+        # Sessions asking for the same missing days at the same time share one request
+        fetched_rows = run_single_flight(
+            "features",
+            (location_key, tuple(features), missing_from, missing_to),
+            partial(
+                fetch_feature_days,
+                lat,
+                lon,
+                radius,
+                missing_from,
+                missing_to,
+                features,
+                radius_unit,
+            ),
+            partial(
+                lookup_feature_days, location_key, features, missing_from, missing_to
+            ),
+        )
+        rows.update(fetched_rows)
+
+    # Expired days are served as they are and refreshed in the background
+    for stale_from, stale_to in group_consecutive_dates(stale_dates):
+        refresh_in_background(
+            "features",
+            (location_key, tuple(features), stale_from, stale_to),
+            partial(
+                fetch_feature_days,
+                lat,
+                lon,
+                radius,
+                stale_from,
+                stale_to,
+                features,
+                radius_unit,
+            ),
+        )
+
+    return make_features_result(rows, dates, features)
+
+
+def get_cached_feature_rows(location_key, features, dates):
+    # Returns the cached {(feature, date): stats} rows, the dates with missing rows and
+    # the dates with expired rows
+    cached_rows = get_cached_feature_days(location_key, features, dates)
+    rows = {key: stats for key, (stats, _) in cached_rows.items()}
+    missing_dates = [
+        date
+        for date in dates
+        if any((feature, date) not in rows for feature in features)
+    ]
+    stale_dates = [
+        date
+        for date in dates
+        if date not in missing_dates
+        and any(cached_rows[(feature, date)][1] for feature in features)
+    ]
+
+    return rows, missing_dates, stale_dates
+
+
+def lookup_feature_days(location_key, features, date_from, date_to):
+    # (found, rows) for a date range, found when none of its rows are missing any more
+    dates = get_dates_in_range(date_from, date_to)
+    rows = peek_cached_feature_days(location_key, features, dates)
+
+    return len(rows) == len(features) * len(dates), rows
+
+
+def make_features_result(rows, dates, features):
+    # Put the per-day rows back together in the same shape as the Features API result
+    results = []
+
+    for date in dates:
+        item = {"date": date}
+
+        for feature in features:
+            if rows[(feature, date)] is not None:
+                item[feature] = rows[(feature, date)]
+
+        results.append(item)
+
+    return {"results": results}
+
+
+@timed("fetch_feature_days")
+def fetch_feature_days(lat, lon, radius, date_from, date_to, features, radius_unit):
+    # Fetch features for a date range and add them to the per-day cache
+    features_result = obtain_features(
+        lat, lon, radius, date_from, date_to, features, radius_unit
+    )
+
+    return set_feature_days(
+        (lat, lon, radius, radius_unit), date_from, date_to, features, features_result
+    )
+
+
+def set_feature_days(location_key, date_from, date_to, features, features_result):
+    # Days the API didn't return are stored as empty so we don't ask for them again
+    rows = {
+        (feature, date): None
+        for feature in features
+        for date in get_dates_in_range(date_from, date_to)
+    }
+
+    for item in features_result["results"]:
+        for feature in features:
+            rows[(feature, item["date"])] = item.get(feature)
+
+    set_cached_feature_days(location_key, rows)
+
+    return rows
+
+
+def obtain_features(lat, lon, radius, date_from, date_to, features, radius_unit="mi"):
     phq = get_predicthq_client()
     features = phq.features.obtain_features(
         location__geo={
@@ -79,15 +472,84 @@ def fetch_features(lat, lon, radius, date_from, date_to, features=[], radius_uni
     return features.to_dict()
 
 
-@st.cache_data
+def get_dates_in_range(date_from, date_to):
+    # Both ends are inclusive, just like the APIs
+    return [
+        date_from + datetime.timedelta(days=i)
+        for i in range((date_to - date_from).days + 1)
+    ]
+
+
+def group_consecutive_dates(dates):
+    # Turn a sorted list of dates into (date_from, date_to) runs of consecutive days
+    ranges = []
+
+    for date in dates:
+        if ranges and ranges[-1][1] + datetime.timedelta(days=1) == date:
+            ranges[-1] = (ranges[-1][0], date)
+        else:
+            ranges.append((date, date))
+
+    return ranges
+
+
+@timed("fetch_demand_surges")
 def fetch_demand_surges(
     lat, lon, radius, date_from, date_to, min_surge_intensity="m", radius_unit="mi"
 ):
     """
     The Demand Surge API works with local time just like the Features API.
+
+    The API is always queried for a 90d window, which is cached once per (origin, radius,
+    intensity, window start) and filtered locally to the date range we're interested in.
+    If a window we've already fetched covers the whole date range it's reused as is.
     """
-    r = requests.get(
-        url="https://api.predicthq.com/v1/demand-surge",
+    window_key = (lat, lon, radius, radius_unit, min_surge_intensity)
+    window_from = get_demand_surge_window_from(window_key, date_from, date_to)
+
+    surge_dates = fetch_demand_surge_window(
+        lat, lon, radius, window_from, min_surge_intensity, radius_unit
+    )
+    add_cached_demand_surge_window(window_key, window_from)
+
+    return filter_demand_surges(surge_dates, date_from, date_to)
+
+
+def get_demand_surge_window_from(window_key, date_from, date_to):
+    # Start of a cached window covering the date range, or a new one starting at date_from
+    return next(
+        (
+            cached_window_from
+            for cached_window_from in get_cached_demand_surge_windows(window_key)
+            if cached_window_from <= date_from
+            and date_to <= cached_window_from + DEMAND_SURGE_WINDOW
+        ),
+        date_from,
+    )
+
+
+def filter_demand_surges(surge_dates, date_from, date_to):
+    results = []
+
+    for demand_surge in surge_dates:
+        # When fetching demand surge dates from the API we have to use a 90d period,
+        # so we need to filter out the dates that are outside of the date range we're interested in.
+        date = datetime.datetime.strptime(demand_surge["date"], "%Y-%m-%d").date()
+
+        if date_from <= date <= date_to:
+            results.append(demand_surge)
+
+    return results
+
+
+@timed("fetch_demand_surge_window")
+@cached("demand_surge")
+def fetch_demand_surge_window(
+    lat, lon, radius, window_from, min_surge_intensity="m", radius_unit="mi"
+):
+    r = send_request(
+        "get",
+        "https://api.predicthq.com/v1/demand-surge",
         headers={
             "Authorization": f"Bearer {get_api_key()}",
             "Accept": "application/json",
@@ -95,35 +557,189 @@ def fetch_demand_surges(
         params={
             "location.origin": f"{lat},{lon}",
             "location.radius": f"{radius}{radius_unit}",
-            "date_from": date_from,
-            "date_to": date_from + datetime.timedelta(days=90),
+            "date_from": window_from,
+            "date_to": window_from + DEMAND_SURGE_WINDOW,
             "min_surge_intensity": min_surge_intensity,
         },
         allow_redirects=False,
     )
+    r.raise_for_status()
 
-    json = r.json()
-    results = []
+    return r.json()["surge_dates"]
 
-    for demand_surge in json["surge_dates"]:
-        # When fetching demand surge dates from the API we have to use a 90d period,
-        # so we need to filter out the dates that are outside of the date range we're interested in.
-        date = datetime.datetime.strptime(demand_surge["date"], "%Y-%m-%d").date()
 
-        if date_from <= date <= date_to:
-            results.append(demand_surge)
+@timed("fetch_windowed_demand_surges")
+def fetch_windowed_demand_surges(
+    lat,
+    lon,
+    radius,
+    date_from,
+    date_to,
+    previous_date_from,
+    previous_date_to,
+    min_surge_intensity="m",
+    radius_unit="mi",
+):
+    """
+    Fetch demand surges for the current and previous periods. When one 90d window can
+    cover both, the previous period is fetched first so the current period can reuse its
+    window, otherwise they're fetched concurrently. Returns a (current, previous) tuple.
+    """
+    fetch_previous = partial(
+        fetch_demand_surges,
+        lat,
+        lon,
+        radius,
+        date_from=previous_date_from,
+        date_to=previous_date_to,
+        min_surge_intensity=min_surge_intensity,
+        radius_unit=radius_unit,
+    )
+    fetch_current = partial(
+        fetch_demand_surges,
+        lat,
+        lon,
+        radius,
+        date_from=date_from,
+        date_to=date_to,
+        min_surge_intensity=min_surge_intensity,
+        radius_unit=radius_unit,
+    )
 
-    return results
+    if date_to - previous_date_from <= DEMAND_SURGE_WINDOW:
+        previous_demand_surges = fetch_previous()
+        demand_surges = fetch_current()
+    else:
+        results = run_in_parallel(
+            {"current": fetch_current, "previous": fetch_previous}
+        )
+        demand_surges = results["current"]
+        previous_demand_surges = results["previous"]
+
+    return demand_surges, previous_demand_surges
 
 
-@st.cache_data
+@timed("fetch_events")
 def fetch_events(
     lat, lon, radius, date_from, date_to, tz="UTC", categories=[], radius_unit="mi"
 ):
     """
     Events API works with UTC time and you can specify a different timezone for the date range
     but all results are always in UTC so must be converted to the local timezone.
+
+    Events for all categories are fetched once and filtered locally by category, so
+    changing the categories doesn't need another API call. With
+    `fetch_events_for_max_radius = true` in the secrets file they can also be fetched for
+    MAX_RADIUS and filtered by distance, see get_events_search_radius.
+
+    The events are returned as a DataFrame, see make_events_frame.
+    """
+    return pd.concat(
+        [
+            events
+            for events, _, _ in stream_events(
+                lat, lon, radius, date_from, date_to, tz, categories, radius_unit
+            )
+        ],
+        ignore_index=True,
+    )
+
+
+def stream_events(
+    lat, lon, radius, date_from, date_to, tz="UTC", categories=[], radius_unit="mi"
+):
+    """
+    Same as fetch_events but walks all the pages of results, yielding an
+    (events, loaded, total) tuple after each page so the first events can be shown while
+    the rest are loading. `events` holds the matching events of that page only, so each
+    page is filtered once, concatenate them (e.g. with pd.concat) for all the events.
+    """
+    search_radius = get_events_search_radius(
+        lat, lon, radius, date_from, date_to, tz, radius_unit
+    )
+
+    for page, loaded, total in iter_events_pages(
+        lat, lon, search_radius, date_from, date_to, tz, radius_unit
+    ):
+        events = filter_events(
+            page["events"],
+            lat,
+            lon,
+            radius,
+            categories,
+            radius_unit,
+            search_radius=search_radius,
+        )
+
+        yield events, loaded, total
+
+
+def get_events_search_radius(lat, lon, radius, date_from, date_to, tz, radius_unit):
+    """
+    With `fetch_events_for_max_radius = true`, events are searched for MAX_RADIUS and
+    filtered by distance locally, so moving the radius slider doesn't need another search.
+    Results are sorted by attendance and capped at `max_events` though, so this is only
+    done when the MAX_RADIUS search returns all of its events. Otherwise events inside
+    the radius would be cut off by busier events further away, and the radius itself is
+    searched instead.
+    """
+    if not get_setting("fetch_events_for_max_radius", False) or radius >= MAX_RADIUS:
+        return radius
+
+    # The first page is cached, so the search that follows starts from it
+    page = search_events_page(lat, lon, MAX_RADIUS, date_from, date_to, tz, radius_unit)
+
+    if page["count"] <= int(get_setting("max_events", MAX_EVENTS)):
+        return MAX_RADIUS
+
+    return radius
+
+
+def iter_events_pages(lat, lon, radius, date_from, date_to, tz, radius_unit):
+    """
+    Yield each page of an events search as (page, loaded, total). The first page tells us
+    how many events there are, then the remaining pages are fetched in parallel. At most
+    `max_events` events are loaded (see the secrets file).
     """
+    max_events = int(get_setting("max_events", MAX_EVENTS))
+    page = search_events_page(lat, lon, radius, date_from, date_to, tz, radius_unit)
+    total = min(page["count"], max_events)
+    loaded = len(page["events"])
+
+    # Request the remaining pages before the first one is used, so they load while it's
+    # being shown
+    pages = iter_in_parallel(
+        [
+            partial(
+                search_events_page,
+                lat,
+                lon,
+                radius,
+                date_from,
+                date_to,
+                tz,
+                radius_unit,
+                offset=offset,
+            )
+            for offset in range(EVENTS_PAGE_SIZE, total, EVENTS_PAGE_SIZE)
+        ],
+        max_workers=int(get_setting("events_page_workers", EVENTS_PAGE_WORKERS)),
+    )
+
+    yield page, min(loaded, total), total
+
+    for page in pages:
+        if loaded + len(page["events"]) > total:
+            page = slice_events_page(page, total - loaded)
+
+        loaded += len(page["events"])
+
+        yield page, loaded, total
+
+
+@timed("search_events_page")
+@cached("events")
+def search_events_page(lat, lon, radius, date_from, date_to, tz, radius_unit, offset=0):
     phq = get_predicthq_client()
     events = phq.events.search(
         within=f"{radius}{radius_unit}@{lat},{lon}",
@@ -132,16 +748,121 @@ def fetch_events(
             "lte": date_to,
             "tz": tz,
         },
-        category=",".join(categories),
+        category=",".join(ALL_CATEGORIES),
         state="active",
-        limit=200,
+        limit=EVENTS_PAGE_SIZE,
+        offset=offset,
         sort="phq_attendance",
+    ).to_dict()
+
+    return {"count": events["count"], "events": make_events_frame(events["results"])}
+
+
+def make_events_frame(results):
+    """
+    Events are kept as a DataFrame with one column per field we use, instead of the
+    nested dicts returned by the SDK. It's much smaller in the cache, faster to pickle
+    and unpickle on every cache hit, and can be filtered and rendered without walking
+    every event in Python.
+
+    Datetimes are in UTC. `geometry` is only kept for polygon events, point events are
+    at (lat, lon). Works with the SDK's results and with the API's JSON (see
+    utils/async_predicthq.py), which leaves out the fields of add-ons the account
+    doesn't have (e.g. phq_attendance or local_rank).
+    """
+    venues = [
+        next(
+            (
+                entity
+                for entity in event.get("entities") or []
+                if entity["type"] == "venue"
+            ),
+            {},
+        )
+        for event in results
+    ]
+    geometries = [(event.get("geo") or {}).get("geometry") for event in results]
+
+    return pd.DataFrame(
+        {
+            "id": pd.Series([event["id"] for event in results], dtype=object),
+            "title": pd.Series([event["title"] for event in results], dtype=object),
+            "category": pd.Categorical(
+                [event["category"] for event in results], categories=ALL_CATEGORIES
+            ),
+            "phq_attendance": np.array(
+                [event.get("phq_attendance") or 0 for event in results], dtype=np.int64
+            ),
+            "rank": np.array(
+                [event.get("rank") or 0 for event in results], dtype=np.int16
+            ),
+            "local_rank": pd.array(
+                [event.get("local_rank") for event in results], dtype="Int16"
+            ),
+            "start": pd.to_datetime([event["start"] for event in results], utc=True),
+            "end": pd.to_datetime([event.get("end") for event in results], utc=True),
+            "predicted_end": pd.to_datetime(
+                [event.get("predicted_end") for event in results], utc=True
+            ),
+            "timezone": pd.Series(
+                [event.get("timezone") for event in results], dtype=object
+            ),
+            # The SDK returns the location as [lon, lat]
+            "lat": np.array([event["location"][1] for event in results], dtype=float),
+            "lon": np.array([event["location"][0] for event in results], dtype=float),
+            "venue_name": pd.Series(
+                [venue.get("name", "") for venue in venues], dtype=object
+            ),
+            "venue_address": pd.Series(
+                [venue.get("formatted_address", "") for venue in venues], dtype=object
+            ),
+            "placekey": pd.Series(
+                [(event.get("geo") or {}).get("placekey") or "" for event in results],
+                dtype=object,
+            ),
+            "geometry": pd.Series(
+                [
+                    geometry
+                    if geometry is not None and geometry["type"] != "Point"
+                    else None
+                    for geometry in geometries
+                ],
+                dtype=object,
+            ),
+        }
     )
 
-    return events.to_dict()
+
+def combine_events_pages(pages):
+    return pd.concat([page["events"] for page in pages], ignore_index=True)
+
+
+def slice_events_page(page, size):
+    return {"count": page["count"], "events": page["events"].iloc[:size]}
 
 
-@st.cache_data
+def filter_events(
+    events, lat, lon, radius, categories, radius_unit="mi", search_radius=None
+):
+    keep = np.full(len(events), True)
+
+    # Events for all categories are fetched together and the selected categories are
+    # applied as a mask (no categories selected means all of them, like the API)
+    if categories:
+        keep &= events["category"].isin(categories).to_numpy()
+
+    if search_radius is not None and search_radius != radius:
+        # The event location is a single point (for polygon events it's the centre point)
+        distances = calc_haversine_distances(
+            lat, lon, events["lat"].to_numpy(), events["lon"].to_numpy()
+        )
+        keep &= distances <= calc_meters(radius, radius_unit)
+
+    return events[keep].reset_index(drop=True)
+
+
+@timed("fetch_event_counts")
+@cached("event_counts")
 def fetch_event_counts(
     lat, lon, radius, date_from, date_to, tz="UTC", radius_unit="mi"
 ):
@@ -159,17 +880,6 @@ def fetch_event_counts(
     return counts.to_dict()
 
 
-def calc_sum_of_features(features_result, features):
-    # sum up the attendance features
-    phq_attendance_sum = 0
-
-    for item in features_result["results"]:
-        for k, v in item.items():
-            phq_attendance_sum += v["stats"]["sum"] if k in features else 0
-
-    return phq_attendance_sum
-
-
 def calc_sum_of_event_counts(counts_result, categories):
     counts = {k: v for k, v in counts_result["categories"].items() if k in categories}
 
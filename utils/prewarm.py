@@ -0,0 +1,127 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from utils.predicthq import (
+    get_api_key,
+    fetch_events,
+    background_requests,
+    ATTENDED_CATEGORIES,
+)
+from utils.metrics import calc_metrics
+from utils.sidebar import (
+    LOCATIONS,
+    get_date_options,
+    get_radius_unit,
+    fetch_suggested_radius,
+)
+from utils.settings import get_setting
+
+# Number of location/date range combinations pre-fetched at a time
+PREWARM_WORKERS = 2
+
+_prewarm_thread = None
+_prewarm_lock = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
+
+def prewarm_location(location, date_option):
+    """
+    Make the same API calls the pages make for a location and date range, at the
+    location's suggested radius (the radius slider's default), so they end up in the
+    cache before anyone visits. The requests are sent as background requests, so they
+    never hold up the people using the app.
+    """
+    with background_requests():
+        suggested_radius = fetch_suggested_radius(
+            location["lat"], location["lon"], radius_unit=get_radius_unit(location)
+        )
+        radius = suggested_radius.get("radius", 2.0)
+        date_from = date_option["date_from"]
+        date_to = date_option["date_to"]
+
+        calc_metrics(location, radius, date_from, date_to)
+
+        # Events are fetched for all categories and filtered locally, so the categories
+        # don't matter here
+        fetch_events(
+            location["lat"],
+            location["lon"],
+            radius,
+            date_from=date_from,
+            date_to=date_to,
+            tz=location["tz"],
+            categories=ATTENDED_CATEGORIES,
+            radius_unit=suggested_radius["radius_unit"],
+        )
+
+
+def prewarm_all(max_workers=None):
+    # Returns the number of combinations that failed, errors are logged
+    combinations = [
+        (location, date_option)
+        for location in LOCATIONS
+        for date_option in get_date_options(location)
+    ]
+    failed = 0
+
+    with ThreadPoolExecutor(
+        max_workers=max_workers or get_setting("prewarm_workers", PREWARM_WORKERS)
+    ) as executor:
+        futures = {
+            executor.submit(prewarm_location, location, date_option): (
+                location,
+                date_option,
+            )
+            for location, date_option in combinations
+        }
+
+        for future, (location, date_option) in futures.items():
+            try:
+                future.result()
+            except Exception:
+                failed += 1
+                logger.exception(
+                    "Pre-warming failed for %s (%s)",
+                    location["id"],
+                    date_option["id"],
+                )
+
+    return failed
+
+
+def run_prewarm_loop(interval, max_workers=None):
+    while True:
+        started = time.time()
+        failed = prewarm_all(max_workers)
+        logger.info(
+            "Pre-warmed the cache in %.1fs (%d failed)", time.time() - started, failed
+        )
+        time.sleep(max(interval - (time.time() - started), 0))
+
+
+def start_background_prewarm():
+    """
+    Pre-warm the cache from a background thread of the app process, every
+    `prewarm_interval` seconds. Disabled unless `prewarm_interval` is set in the secrets
+    file, the thread is only started once per process.
+    """
+    global _prewarm_thread
+
+    interval = get_setting("prewarm_interval", None)
+
+    if not interval or get_api_key() is None:
+        return
+
+    with _prewarm_lock:
+        if _prewarm_thread is not None:
+            return
+
+        _prewarm_thread = threading.Thread(
+            target=run_prewarm_loop,
+            args=(interval,),
+            name="prewarm",
+            daemon=True,
+        )
+        _prewarm_thread.start()
@@ -0,0 +1,36 @@
+import contextlib
+import streamlit as st
+
+# Settings that take precedence over the secrets file, see override_settings
+_overrides = {}
+
+
+def get_setting(name, default=None):
+    """
+    Optional settings live in the Streamlit secrets file (`.streamlit/secrets.toml`) next
+    to the API key. Falls back to the default when the setting (or the file) is missing.
+    """
+    if name in _overrides:
+        return _overrides[name]
+
+    try:
+        return st.secrets.get(name, default)
+    except FileNotFoundError:
+        return default
+
+
+@contextlib.contextmanager
+def override_settings(**settings):
+    """
+    Use these settings instead of the ones in the secrets file inside the block, e.g. to
+    run the app's functions outside of Streamlit (see utils/benchmark.py). Settings that
+    are read once (e.g. the rate limits) keep the value they had the first time.
+    """
+    previous = dict(_overrides)
+    _overrides.update(settings)
+
+    try:
+        yield
+    finally:
+        _overrides.clear()
+        _overrides.update(previous)
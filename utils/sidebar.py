@@ -1,107 +1,112 @@
 import streamlit as st
 import datetime
 import pytz
-from utils.predicthq import get_api_key, get_predicthq_client
+import pandas as pd
+from utils.predicthq import get_api_key, get_predicthq_client, MAX_RADIUS
 from utils.code_examples import get_code_example
+from utils.cache import cached, get_cache_stats
+from utils.settings import get_setting
+from utils.timings import timed, make_timings_frame, timings_to_json
+
+
+LOCATIONS = [
+    {
+        "id": "san-francisco",
+        "name": "San Francisco, US",
+        "address": "302 Potrero Ave",
+        "lat": 37.76562,
+        "lon": -122.40797,
+        "tz": "America/Los_Angeles",
+        "units": "imperial",
+    },
+    {
+        "id": "new-york",
+        "name": "New York, US",
+        "address": "700 6th Ave",
+        "lat": 40.74425,
+        "lon": -73.99325,
+        "tz": "America/New_York",
+        "units": "imperial",
+    },
+    {
+        "id": "los-angeles",
+        "name": "Los Angeles, US",
+        "address": "459 S Vermont Ave",
+        "lat": 34.06860,
+        "lon": -118.29330,
+        "tz": "America/Los_Angeles",
+        "units": "imperial",
+    },
+    {
+        "id": "toronto",
+        "name": "Toronto, CA",
+        "address": "153 Yorkville Ave",
+        "lat": 43.67097,
+        "lon": -79.39440,
+        "tz": "America/Toronto",
+        "units": "metric",
+    },
+    {
+        "id": "london",
+        "name": "London, UK",
+        "address": "25 Ganton St",
+        "lat": 51.51336,
+        "lon": -0.13952,
+        "tz": "Europe/London",
+        "units": "metric",
+    },
+    {
+        "id": "paris",
+        "name": "Paris, FR",
+        "address": "81 Av. Bosquet",
+        "lat": 48.85545,
+        "lon": 2.30526,
+        "tz": "Europe/Paris",
+        "units": "metric",
+    },
+    {
+        "id": "berlin",
+        "name": "Berlin, DE",
+        "address": "Budapester Str. 40",
+        "lat": 52.50649,
+        "lon": 13.33737,
+        "tz": "Europe/Berlin",
+        "units": "metric",
+    },
+    {
+        "id": "sydney",
+        "name": "Sydney, AU",
+        "address": "25 Martin Pl",
+        "lat": -33.86790,
+        "lon": 151.20943,
+        "tz": "Australia/Sydney",
+        "units": "metric",
+    },
+    {
+        "id": "auckland",
+        "name": "Auckland, NZ",
+        "address": "85 Fort Street",
+        "lat": -36.84564,
+        "lon": 174.76982,
+        "tz": "Pacific/Auckland",
+        "units": "metric",
+    },
+]
 
 
 def show_sidebar_options():
-    locations = [
-        {
-            "id": "san-francisco",
-            "name": "San Francisco, US",
-            "address": "302 Potrero Ave",
-            "lat": 37.76562,
-            "lon": -122.40797,
-            "tz": "America/Los_Angeles",
-            "units": "imperial",
-        },
-        {
-            "id": "new-york",
-            "name": "New York, US",
-            "address": "700 6th Ave",
-            "lat": 40.74425,
-            "lon": -73.99325,
-            "tz": "America/New_York",
-            "units": "imperial",
-        },
-        {
-            "id": "los-angeles",
-            "name": "Los Angeles, US",
-            "address": "459 S Vermont Ave",
-            "lat": 34.06860,
-            "lon": -118.29330,
-            "tz": "America/Los_Angeles",
-            "units": "imperial",
-        },
-        {
-            "id": "toronto",
-            "name": "Toronto, CA",
-            "address": "153 Yorkville Ave",
-            "lat": 43.67097,
-            "lon": -79.39440,
-            "tz": "America/Toronto",
-            "units": "metric",
-        },
-        {
-            "id": "london",
-            "name": "London, UK",
-            "address": "25 Ganton St",
-            "lat": 51.51336,
-            "lon": -0.13952,
-            "tz": "Europe/London",
-            "units": "metric",
-        },
-        {
-            "id": "paris",
-            "name": "Paris, FR",
-            "address": "81 Av. Bosquet",
-            "lat": 48.85545,
-            "lon": 2.30526,
-            "tz": "Europe/Paris",
-            "units": "metric",
-        },
-        {
-            "id": "berlin",
-            "name": "Berlin, DE",
-            "address": "Budapester Str. 40",
-            "lat": 52.50649,
-            "lon": 13.33737,
-            "tz": "Europe/Berlin",
-            "units": "metric",
-        },
-        {
-            "id": "sydney",
-            "name": "Sydney, AU",
-            "address": "25 Martin Pl",
-            "lat": -33.86790,
-            "lon": 151.20943,
-            "tz": "Australia/Sydney",
-            "units": "metric",
-        },
-        {
-            "id": "auckland",
-            "name": "Auckland, NZ",
-            "address": "85 Fort Street",
-            "lat": -36.84564,
-            "lon": 174.76982,
-            "tz": "Pacific/Auckland",
-            "units": "metric",
-        },
-    ]
-
     # Work out which location is currently selected
     index = 0
 
     if "location" in st.session_state:
-        for idx, location in enumerate(locations):
+        for idx, location in enumerate(LOCATIONS):
             if st.session_state["location"]["id"] == location["id"]:
                 index = idx
                 break
 
     location = st.sidebar.selectbox(
         "Restaurant",
-        locations,
+        LOCATIONS,
         index=index,
         format_func=lambda x: x["name"],
         help="Select the restaurant location.",
@@ -110,28 +115,7 @@ def show_sidebar_options():
     )
 
     # Prepare the date range (today + 30d as the default)
-    tz = pytz.timezone(location["tz"])
-    today = datetime.datetime.now(tz).date()
-    date_options = [
-        {
-            "id": "next_7_days",
-            "name": "Next 7 days",
-            "date_from": today,
-            "date_to": today + datetime.timedelta(days=7),
-        },
-        {
-            "id": "next_30_days",
-            "name": "Next 30 days",
-            "date_from": today,
-            "date_to": today + datetime.timedelta(days=30),
-        },
-        {
-            "id": "next_90_days",
-            "name": "Next 90 days",
-            "date_from": today,
-            "date_to": today + datetime.timedelta(days=90),
-        },
-    ]
+    date_options = get_date_options(location)
 
     # Work out which date is currently selected
     index = 2  # Default to next 90 days
@@ -153,9 +137,7 @@ def show_sidebar_options():
     )
 
     # Use an appropriate radius unit depending on location
-    radius_unit = (
-        "mi" if "units" in location and location["units"] == "imperial" else "km"
-    )
+    radius_unit = get_radius_unit(location)
 
     st.session_state.suggested_radius = fetch_suggested_radius(
         location["lat"], location["lon"], radius_unit=radius_unit
@@ -166,7 +148,7 @@ def show_sidebar_options():
     st.sidebar.slider(
         f"Suggested Radius around restaurant ({radius_unit})",
         0.0,
-        10.0,
+        MAX_RADIUS,
         st.session_state.suggested_radius.get("radius", 2.0),
         0.1,
         help="[Suggested Radius Docs](https://docs.predicthq.com/resources/suggested-radius)",
@@ -174,7 +156,39 @@ def show_sidebar_options():
     )
 
 
-@st.cache_data
+def get_date_options(location):
+    # The date ranges start today in the location's timezone
+    tz = pytz.timezone(location["tz"])
+    today = datetime.datetime.now(tz).date()
+
+    return [
+        {
+            "id": "next_7_days",
+            "name": "Next 7 days",
+            "date_from": today,
+            "date_to": today + datetime.timedelta(days=7),
+        },
+        {
+            "id": "next_30_days",
+            "name": "Next 30 days",
+            "date_from": today,
+            "date_to": today + datetime.timedelta(days=30),
+        },
+        {
+            "id": "next_90_days",
+            "name": "Next 90 days",
+            "date_from": today,
+            "date_to": today + datetime.timedelta(days=90),
+        },
+    ]
+
+
+def get_radius_unit(location):
+    return "mi" if "units" in location and location["units"] == "imperial" else "km"
+
+
+@timed("fetch_suggested_radius")
+@cached("suggested_radius")
 def fetch_suggested_radius(lat, lon, radius_unit="mi", industry="restaurants"):
     phq = get_predicthq_client()
     suggested_radius = phq.radius.search(
@@ -207,3 +221,28 @@ def show_map_sidebar_code_examples():
     st.sidebar.caption(
         "Get the code for this app at [GitHub](https://github.com/predicthq/streamlit-restaurant-demo)"
     )
+
+
+def show_cache_stats():
+    # Enable with `show_cache_stats = true` in the secrets file
+    if not get_setting("show_cache_stats", False):
+        return
+
+    with st.sidebar.expander("Cache statistics"):
+        st.dataframe(pd.DataFrame(get_cache_stats()).T)
+
+
+def show_timings(timings):
+    # Enable with `show_timings = true` in the secrets file, see utils/timings.py
+    if timings is None:
+        return
+
+    with st.sidebar.expander("Timings"):
+        st.caption(f"Page run in {timings['seconds']:.2f}s")
+        st.dataframe(make_timings_frame(timings))
+        st.download_button(
+            label="Download timings as JSON",
+            data=timings_to_json(timings),
+            file_name=f"timings-{timings['name']}-{timings['started']:.0f}.json",
+            mime="application/json",
+        )
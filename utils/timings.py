@@ -0,0 +1,155 @@
+import contextlib
+import contextvars
+import functools
+import json
+import logging
+import pickle
+import threading
+import time
+import pandas as pd
+from utils.cache import track_cache_lookups
+from utils.settings import get_setting
+
+# Timings recorded in the current rerun, see track_timings
+_timings = contextvars.ContextVar("timings", default=None)
+
+# How deep the current timed call is nested in other timed calls
+_depth = contextvars.ContextVar("timing_depth", default=0)
+
+logger = logging.getLogger(__name__)
+
+
+@contextlib.contextmanager
+def track_timings(name):
+    """
+    Record the calls to timed functions made inside the block (including calls made by
+    run_in_parallel), e.g. for one rerun of a page. Only enabled with
+    `show_timings = true` in the secrets file, otherwise this yields None and timed
+    functions cost next to nothing. When enabled, the timings are also logged as a
+    single JSON line when the block ends.
+    """
+    if not get_setting("show_timings", False):
+        yield None
+        return
+
+    timings = {
+        "name": name,
+        "started": time.time(),
+        "calls": [],
+        "lock": threading.Lock(),
+    }
+    token = _timings.set(timings)
+
+    try:
+        yield timings
+    finally:
+        _timings.reset(token)
+        timings["seconds"] = time.time() - timings["started"]
+        logger.info(timings_to_json(timings))
+
+
+def timed(name):
+    """
+    Record the wall time, cache hits/misses and result size of every call to the
+    decorated function while timings are tracked (see track_timings).
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            timings = _timings.get()
+
+            if timings is None:
+                return func(*args, **kwargs)
+
+            started = time.time()
+            depth_token = _depth.set(_depth.get() + 1)
+            error = None
+
+            try:
+                with track_cache_lookups() as lookups:
+                    result = func(*args, **kwargs)
+            except BaseException as e:
+                error = repr(e)
+                raise
+            finally:
+                seconds = time.time() - started
+                _depth.reset(depth_token)
+                call = {
+                    "name": name,
+                    "depth": _depth.get(),
+                    "start": started - timings["started"],
+                    "seconds": seconds,
+                    "cache_hits": sum(lookup["hits"] for lookup in lookups),
+                    "cache_misses": sum(lookup["misses"] for lookup in lookups),
+                    "cache_seconds": sum(lookup["seconds"] for lookup in lookups),
+                    "payload_bytes": (
+                        None if error else calc_payload_size(result, args, kwargs)
+                    ),
+                    "error": error,
+                }
+
+                with timings["lock"]:
+                    timings["calls"].append(call)
+
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def calc_payload_size(result, args, kwargs):
+    # Size of the result, or of the first frame passed in for functions that only draw
+    if result is None:
+        result = next(
+            (
+                value
+                for value in [*args, *kwargs.values()]
+                if isinstance(value, pd.DataFrame)
+            ),
+            None,
+        )
+
+    if result is None:
+        return None
+
+    if isinstance(result, pd.DataFrame):
+        return int(result.memory_usage(index=True, deep=True).sum())
+
+    try:
+        return len(pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return None
+
+
+def make_timings_frame(timings):
+    # One row per call, in the order they started, nested calls are indented
+    calls = pd.DataFrame(
+        sorted(timings["calls"], key=lambda call: call["start"]),
+        columns=[
+            "name",
+            "depth",
+            "start",
+            "seconds",
+            "cache_hits",
+            "cache_misses",
+            "cache_seconds",
+            "payload_bytes",
+            "error",
+        ],
+    )
+    calls["name"] = calls["depth"].map(lambda depth: "· " * depth) + calls["name"]
+
+    return calls.drop(columns="depth").set_index("name")
+
+
+def timings_to_json(timings):
+    return json.dumps(
+        {
+            "name": timings["name"],
+            "started": timings["started"],
+            "seconds": timings.get("seconds"),
+            "calls": sorted(timings["calls"], key=lambda call: call["start"]),
+        }
+    )